@@ -5,9 +5,11 @@ import argparse
 from .compare import (
     unpack_existing_into_stream_pairs,
     get_coverages_and_descriptions,
-    unzip_to_stringio,
+    open_in_zip,
 )
-from .parser import Stream
+from .parser import Stream, Record
+from itertools import chain
+import shutil
 from zipfile import ZipFile
 
 def prepare_args(parser: argparse.ArgumentParser):
@@ -17,21 +19,34 @@ def prepare_args(parser: argparse.ArgumentParser):
                         help="Output archive path")
 
 def copy_file_between_zips(source: ZipFile, destination: ZipFile, file_name: str):
-    destination.writestr(file_name, unzip_to_stringio(source, file_name).getvalue())
+    with (
+        source.open(file_name, 'r') as fsrc,
+        destination.open(file_name, 'w') as fdst,
+    ):
+        shutil.copyfileobj(fsrc, fdst)
 
 def drop_lines_not_in_other(this_stream: Stream, other_stream: Stream, this_prefix: str) -> Stream:
-    output_coverage_source_files = other_stream.records.keys()
+    filtered_records: dict[str, Record] = {}
     for name, record in this_stream.records.items():
-        if record.source_file not in output_coverage_source_files:
-            this_stream.records.pop(name)
-        elif this_prefix in record.lines_per_prefix:
+        other_record = other_stream.records.get(record.source_file, None)
+        if other_record is None:
+            continue
+
+        if this_prefix in record.lines_per_prefix:
+            # Line numbers of all entries in the other record
+            other_line_numbers = {
+                line.split(',', 1)[0]
+                for line in chain.from_iterable(other_record.lines_per_prefix.values())
+                if ',' in line
+            }
             record.lines_per_prefix[this_prefix] = [
                 line
-                for line in record.lines_per_prefix["TEST"]
-                if other_stream.has_entries_for_source_file_line(
-                    record.source_file, line.split(",")[0]
-                )
+                for line in record.lines_per_prefix[this_prefix]
+                if line.split(',', 1)[0] in other_line_numbers
             ]
+        filtered_records[name] = record
+
+    this_stream.records = filtered_records
     return this_stream
 
 def store_filtered(source_zip: ZipFile, target_zip: ZipFile, desc_path: str, info_path: str, output_streams: Stream):
@@ -39,7 +54,8 @@ def store_filtered(source_zip: ZipFile, target_zip: ZipFile, desc_path: str, inf
         return
     info_base = info_path.removesuffix(".info")
     desc_stream = Stream(source_file_prefix="SN")
-    desc_stream.load(unzip_to_stringio(source_zip, desc_path))
+    with open_in_zip(source_zip, desc_path) as desc_file:
+        desc_stream.load(desc_file)
 
     output_stream = output_streams[info_base]
     filtered_stream = drop_lines_not_in_other(desc_stream, output_stream, "TEST")
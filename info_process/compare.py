@@ -6,11 +6,11 @@ import os.path
 import io
 import json
 from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
 from .pack import get_coverage_description_paired_files
-from .parser import Stream, Record
+from .parser import Stream, Record, get_line_number_and_hit_count
 from dataclasses import dataclass
-from functools import reduce
-from tabulate import tabulate
+from operator import attrgetter
 from zipfile import ZipFile
 
 GREEN_FORMATTING=""
@@ -26,6 +26,10 @@ SUPPORTED_CATEGORIES=["line", "branch", "cond", "toggle", "assert", "fsm"]
 @dataclass
 class CoverageCompare:
     """ Represents difference between two coverage files for one metric (line/branch/...) """
+    # Declared explicitly instead of using `dataclass(slots=True)` to keep Python 3.9 supported
+    __slots__ = ('file_name', 'base_total', 'other_total', 'base_hits', 'other_hits',
+                 '_present_in_base', '_present_in_other')
+
     file_name: str
 
     # `base` or `other` pair can be None if source file is present only in one file.
@@ -34,6 +38,22 @@ class CoverageCompare:
     base_hits: Optional[int]
     other_hits: Optional[int]
 
+    def __post_init__(self):
+        # Totals and hits are only ever accumulated, so whether they are set can't change after construction
+        if self.base_total is None or self.base_hits is None:
+            assert self.base_total is None and self.base_hits is None, \
+                f"Either both or none of {self.base_total=} and {self.base_hits=} must be set, {self.file_name=}"
+            self._present_in_base = False
+        else:
+            self._present_in_base = True
+
+        if self.other_total is None or self.other_hits is None:
+            assert self.other_total is None and self.other_hits is None, \
+                f"Either both or none of {self.other_total=} and {self.other_hits=} must be set, {self.file_name=}"
+            self._present_in_other = False
+        else:
+            self._present_in_other = True
+
     def __lt__(self, other: 'CoverageCompare') -> bool:
         return self.file_name < other.file_name
 
@@ -92,21 +112,11 @@ class CoverageCompare:
 
     @property
     def present_in_base(self) -> bool:
-        if self.base_total is None or self.base_hits is None:
-            assert self.base_total is None and self.base_hits is None, \
-                f"Either both or none of {self.base_total=} and {self.base_hits=} must be set, {self.file_name=}"
-            return False
-        else:
-            return True
+        return self._present_in_base
 
     @property
     def present_in_other(self) -> bool:
-        if self.other_total is None or self.other_hits is None:
-            assert self.other_total is None and self.other_hits is None, \
-                f"Either both or none of {self.other_total=} and {self.other_hits=} must be set, {self.file_name=}"
-            return False
-        else:
-            return True
+        return self._present_in_other
 
     @property
     def present_in_both(self) -> bool:
@@ -119,6 +129,63 @@ class CoverageCompare:
         return (self.total_delta != 0 or self.hits_delta != 0)
 
 
+class RecordHitCounts:
+    """ Hit counts of DA and BRDA entries of one source file, collected while its records are loaded """
+    def __init__(self):
+        self.brda_hit_counts: list[int] = []
+        self.brda_lines: set[int] = set()
+        self.da_entries: list[tuple[int, int]] = []
+
+    def all_and_covered_lines_count(self, source_file: str) -> tuple[int, int]:
+        # Complexity here is caused by line coverage for which "normal" lines only have DA entries
+        # but, e.g., lines inside FOR loops have BRDA entries which should be counted instead.
+        #
+        # Therefore BRDA entries are counted unless there is a DA entry for a line without BRDA entries.
+        # Hit counts are never negative, so uncovered entries can be counted by `list.count`.
+        total = len(self.brda_hit_counts)
+        covered = total - self.brda_hit_counts.count(0)
+        lines_with_da_entries: set[int] = set()
+        for line_no, hit_count in self.da_entries:
+            # DA entries are only added for lines without any BRDA entries.
+            if line_no not in self.brda_lines:
+                # It is assumed that there's only one DA entry per line so let's
+                # make sure it's true.
+                assert line_no not in lines_with_da_entries, \
+                        f"Multiple DA lines for {line_no} line in {source_file}"
+                lines_with_da_entries.add(line_no)
+
+                total += 1
+                if hit_count > 0:
+                    covered += 1
+        return total, covered
+
+
+class CoverageStream(Stream):
+    """ Stream which counts hits per source file while loading, so that entries don't have to be parsed again for comparison """
+    def __init__(self, path: Optional[str] = None):
+        # Only hit counts are compared, so line info isn't needed
+        super().__init__(path=path, track_line_info=False)
+        self.hit_counts: dict[str, RecordHitCounts] = {}
+        self.install_handler(['SF'], self._add_source_file)
+        self.install_handler(['DA', 'BRDA'], self._count_hits)
+
+    def _add_source_file(self, prefix: str, path: str, file: Record) -> str:
+        # Source files without any entries are compared as well
+        self.hit_counts.setdefault(path, RecordHitCounts())
+        return path
+
+    def _count_hits(self, prefix: str, params: str, file: Record) -> Optional[str]:
+        counts = self.hit_counts.setdefault(file.source_file, RecordHitCounts())
+        line_no, hit_count = get_line_number_and_hit_count(params)
+        if prefix == 'BRDA':
+            counts.brda_hit_counts.append(hit_count)
+            counts.brda_lines.add(line_no)
+        else:
+            counts.da_entries.append((line_no, hit_count))
+        # Only the hit counts are compared, so the entries aren't stored in the record
+        return None
+
+
 def prepare_args(parser: argparse.ArgumentParser):
     parser.add_argument('inputs', type=str, nargs="+", default=[],
                         help='.info files to be compared')
@@ -138,75 +205,44 @@ def prepare_args(parser: argparse.ArgumentParser):
     parser.add_argument('--skip-type', choices=SUPPORTED_CATEGORIES, action='append', dest='skipped_categories',
                         help='Skip the given coverage type in the output, it can be used multiple times')
 
-def compare_records(name: str, this_records: dict[str, Record], other_records: dict[str, Record]) -> list[CoverageCompare]:
-    # Complexity here is caused by line coverage for which "normal" lines only have DA entries
-    # but, e.g., lines inside FOR loops have BRDA entries which should be counted instead.
-    #
-    # Therefore the returned dict contains BRDA entries unless there is a DA entry
-    # for a line without BRDA entries.
-    def get_entries_per_record(records: dict[str, Record]) -> dict[str, list[str]]:
-        result = {}
-        for source_file, record in records.items():
-            assert source_file not in result, f"Source file duplicated: {source_file}"
-            result[source_file] = {}
-
-            entries = record.lines_per_prefix.get('BRDA', [])
-            lines_with_brda_entries = set(
-                map(lambda brda: int(brda.split(',')[0]), entries)
-            )
-
-            lines_with_da_entries: set[int] = set()
-            for da_entry in record.lines_per_prefix.get('DA', []):
-                line_no = int(da_entry.split(',')[0])
-                # DA entries are only added for lines without any BRDA entries.
-                if line_no not in lines_with_brda_entries:
-                    # It is assumed that there's only one DA entry per line so let's
-                    # make sure it's true.
-                    assert line_no not in lines_with_da_entries, \
-                            f"Multiple DA lines for {line_no} line in {source_file}"
-                    lines_with_da_entries.add(line_no)
-
-                    entries.append(da_entry)
-            result[source_file] = entries
-        return result
-
-    this_records_lines = get_entries_per_record(this_records)
-    other_records_lines = get_entries_per_record(other_records)
-
-    if len(set(this_records_lines.keys()) & set(other_records_lines.keys())) == 0:
-        print(f"There are no common source files for {name}")
+def compare_records(name: str, this_records: dict[str, RecordHitCounts], other_records: dict[str, RecordHitCounts],
+                    sort: bool = True) -> list[CoverageCompare]:
+    this_records_counts = {source_file: counts.all_and_covered_lines_count(source_file) for source_file, counts in this_records.items()}
+    other_records_counts = {source_file: counts.all_and_covered_lines_count(source_file) for source_file, counts in other_records.items()}
 
-    def all_and_covered_lines_count(dataset: list[str]) -> tuple[int, int]:
-        def is_line_covered(line_entry) -> bool:
-            return int(line_entry.split(",")[-1]) > 0
-        return len(dataset), sum(1 for l in dataset if is_line_covered(l))
+    if this_records_counts.keys().isdisjoint(other_records_counts):
+        print(f"There are no common source files for {name}")
 
     result = []
     # Add CoverageCompare objects for all source files from the `other` file.
     # Source files without coverage in `this` file will have `base_total` and `base_hits` unset.
-    for file_name, other_lines in other_records_lines.items():
-        this_lines = this_records_lines.pop(file_name, None)
-        base_total, base_hits = all_and_covered_lines_count(this_lines) if this_lines else (None, None)
-        other_total, other_hits = all_and_covered_lines_count(other_lines)
+    for file_name, (other_total, other_hits) in other_records_counts.items():
+        this_counts = this_records_counts.pop(file_name, None)
+        # Source files without any entries in `this` file are treated as missing
+        base_total, base_hits = this_counts if this_counts and this_counts[0] > 0 else (None, None)
         result.append(CoverageCompare(file_name, base_total, other_total, base_hits, other_hits))
 
     # Let's add CoverageCompare objects for all source files from `this` absent in `other`.
-    for file_name, this_lines in this_records_lines.items():
-        base_total, base_hits = all_and_covered_lines_count(this_lines)
+    for file_name, (base_total, base_hits) in this_records_counts.items():
         other_total, other_hits = (None, None)
         result.append(CoverageCompare(file_name, base_total, other_total, base_hits, other_hits))
 
-    return sorted(result)
+    if sort:
+        result.sort(key=attrgetter('file_name'))
+    return result
 
 def format_delta(value, percentage: bool = False) -> str:
     if value == 0:
         return "--"
 
-    # NOTE: Plus is added for positive delta, minus for negative is in value already.
-    prefix_string = f"{GREEN_FORMATTING}+" if value > 0 else RED_FORMATTING
-    value_string = f"{value:.2f}%" if percentage else str(value)
+    # NOTE: The `+` format option adds a plus for positive deltas, minus for negative is added anyway.
+    value_string = f"{value:+.2f}%" if percentage else f"{value:+}"
+    if not NO_FORMATTING:
+        # Colours are disabled, there is nothing to wrap the value with
+        return value_string
 
-    return f"{prefix_string}{value_string}{NO_FORMATTING}"
+    formatting = GREEN_FORMATTING if value > 0 else RED_FORMATTING
+    return f"{formatting}{value_string}{NO_FORMATTING}"
 
 def prepare_table_data(name: str, comparison: CoverageCompare) -> list[str]:
     return [
@@ -214,23 +250,24 @@ def prepare_table_data(name: str, comparison: CoverageCompare) -> list[str]:
         f"{comparison.other_coverage:.2f}%",
         f"{comparison.other_hits} [{format_delta(comparison.hits_delta)}]",
         f"{comparison.other_total} [{format_delta(comparison.total_delta)}]",
-        f"{format_delta(comparison.coverage_delta, percentage=True)}",
+        format_delta(comparison.coverage_delta, percentage=True),
     ]
 
 def print_summary(table: bool, markdown: bool, headers: list[str], data: list[list[str]]):
     if table:
+        # Only imported when needed since CSV output doesn't use it and the import isn't cheap
+        from tabulate import tabulate
+
         fmt = "github" if markdown else "rounded_grid"
         print(tabulate(data, headers=headers, tablefmt=fmt))
     else:
         # CSV format
-        print(','.join(headers))
-        for line in data:
-            print(','.join(line))
+        print('\n'.join([','.join(headers), *(','.join(line) for line in data)]))
 
-def report_changes(use_table: bool, use_markdown: bool, name: str, stream_this: Stream,
-                   stream_other: Stream, print_all_data: bool, report_missing: str):
+def report_changes(use_table: bool, use_markdown: bool, name: str, path_this: str,
+                   path_other: str, comparison_data: list[CoverageCompare],
+                   print_all_data: bool, report_missing: str):
     headers = ["File Name", "Coverage %", "Hit[Δ]", "Total[Δ]", "Coverage Δ %"]
-    comparison_data = compare_records(name, stream_this.records, stream_other.records)
 
     def should_be_printed(comparison: CoverageCompare) -> bool:
         return print_all_data or comparison.is_different
@@ -258,7 +295,7 @@ def report_changes(use_table: bool, use_markdown: bool, name: str, stream_this:
             f"{comparison.base_total}",
         ] for comparison in comparison_data if not comparison.present_in_other]
         if data:
-            print(f"# {name} diff: Only in {stream_this.path}")
+            print(f"# {name} diff: Only in {path_this}")
             print_summary(use_table, use_markdown, headers, data)
 
     if report_missing in ['both', 'other']:
@@ -269,17 +306,21 @@ def report_changes(use_table: bool, use_markdown: bool, name: str, stream_this:
             f"{comparison.other_total}",
         ] for comparison in comparison_data if not comparison.present_in_base]
         if data:
-            print(f"# {name} diff: Only in {stream_other.path}")
+            print(f"# {name} diff: Only in {path_other}")
             print_summary(use_table, use_markdown, headers, data)
 
-def summary_with_categories(use_table: bool, use_markdown: bool, streams_pairs: dict[str, tuple[Stream, Stream]], categories: list[str]):
+def summary_with_categories(use_table: bool, use_markdown: bool, comparisons: dict[str, list[CoverageCompare]], categories: list[str]):
     categorized_stats = {key: CoverageCompare("", 0, 0, 0, 0) for key in categories}
-    for name, (this, other) in streams_pairs.items():
-        if any(matching_categories:=[x for x in categories if x in name]):
+    for name, records in comparisons.items():
+        if matching_categories := [x for x in categories if x in name]:
             assert len(matching_categories) == 1, f"All Datasets should match only one category! Offending name: {name}; matching categories: {matching_categories}"
             category = matching_categories[0]
-            records = compare_records(name, this.records, other.records)
-            categorized_stats[category] += reduce(lambda x,y : x+y, records)
+            stats = categorized_stats[category]
+            for record in records:
+                stats.base_total += record.base_total or 0
+                stats.other_total += record.other_total or 0
+                stats.base_hits += record.base_hits or 0
+                stats.other_hits += record.other_hits or 0
         else:
             raise AssertionError(f"Dataset {name} does not fit to any of the categories: {categories}")
 
@@ -300,7 +341,8 @@ def get_coverages_and_descriptions(zip_file: ZipFile) -> list[tuple[str]]:
     descriptions=[f for f in files_in_zip if f.endswith(".desc")]
     assert "config.json" in files_in_zip, f"{zip_file.filename} is not a valid archive - does not contain `config.json`"
 
-    config_json = json.load(unzip_to_stringio(zip_file, "config.json"))
+    with open_in_zip(zip_file, "config.json") as config_file:
+        config_json = json.load(config_file)
 
     coverage_description_pairs = get_coverage_description_paired_files(config_json,
                                                                        available_coverages=coverages,
@@ -312,45 +354,72 @@ def get_coverages_and_descriptions_sets(zip_file: ZipFile) -> tuple[list[str]]:
     return set(coverage_tuple), set(description_tuple)
 
 
-def unzip_to_stringio(zip_file: ZipFile, name: str) -> io.StringIO:
-    unzipped = zip_file.read(name).decode('utf-8')
-    return io.StringIO(unzipped)
+def open_in_zip(zip_file: ZipFile, name: str) -> io.TextIOWrapper:
+    # The file is decompressed while it's being read, lines are only split on '\n'
+    return io.TextIOWrapper(zip_file.open(name, 'r'), encoding='utf-8', newline='\n')
+
+
+def get_dataset_pairs(this_zip: ZipFile, other_zip: ZipFile, categories: Optional[list[str]] = None) -> dict[str, tuple[Optional[str], Optional[str]]]:
+    """ Pairs coverage files from both archives by dataset name, `None` marks a file missing in one of them """
+    this_files, _ = get_coverages_and_descriptions_sets(this_zip)
+    other_files, _ = get_coverages_and_descriptions_sets(other_zip)
+    assert len(this_files & other_files) > 0, "\n".join([
+        "Archives need to have at least one common dataset file to be comparable",
+        f"    {this_files=}",
+        f"    {other_files=}",
+    ])
+
+    # Let's skip files belonging to categories (coverage types) that we won't be comparing.
+    if categories is not None:
+        this_files = {file_path for file_path in this_files if any(cat in file_path for cat in categories)}
+        other_files = {file_path for file_path in other_files if any(cat in file_path for cat in categories)}
+
+    dataset_pairs = {}
+    common_files = this_files & other_files
+    for common_file in common_files:
+        dataset_pairs[extract_file_name(common_file)] = (common_file, common_file)
+    for this_only_file in this_files - common_files:
+        dataset_pairs[extract_file_name(this_only_file)] = (this_only_file, None)
+    for other_only_file in other_files - common_files:
+        dataset_pairs[extract_file_name(other_only_file)] = (None, other_only_file)
+    return dataset_pairs
+
+
+def unpack_existing_into_stream_pairs(path_this: str, path_other: str, categories: Optional[list[str]] = None) -> dict[str, tuple[Stream, Stream]]:
+    def unzip_to_stream(zip_file: ZipFile, name: Optional[str], path: str) -> Stream:
+        stream = Stream(path=path, track_line_info=False)
+        if name is not None:
+            with open_in_zip(zip_file, name) as info_io:
+                stream.load(info_io)
+        return stream
 
+    with ZipFile(path_this, 'r') as this_zip, ZipFile(path_other, 'r') as other_zip:
+        return {
+            name: (unzip_to_stream(this_zip, this_file, path_this), unzip_to_stream(other_zip, other_file, path_other))
+            for name, (this_file, other_file) in get_dataset_pairs(this_zip, other_zip, categories).items()
+        }
 
-def unpack_existing_into_stream_pairs(path_this: str, path_other: str, categories: list[str]) -> dict[str, tuple[Stream, Stream]]:
-    def unzip_to_stream(zip_file: ZipFile, name: str, path: str) -> Stream:
-        stream = Stream(path=path)
-        info_io = unzip_to_stringio(zip_file, name)
-        stream.load(info_io)
-        return stream
 
-    stream_pairs = {}
+def load_hit_counts_from_zip(path: str, name: Optional[str]) -> dict[str, RecordHitCounts]:
+    """ Runs in worker processes, only hit counts are sent back as they are much smaller than the records """
+    stream = CoverageStream(path=path)
+    if name is not None:
+        with ZipFile(path, 'r') as zip_file, open_in_zip(zip_file, name) as info_io:
+            stream.load(info_io)
+    return stream.hit_counts
 
+
+def load_hit_count_pairs_from_zips(path_this: str, path_other: str, categories: list[str]) -> dict[str, tuple[dict[str, RecordHitCounts], dict[str, RecordHitCounts]]]:
     with ZipFile(path_this, 'r') as this_zip, ZipFile(path_other, 'r') as other_zip:
-        this_files, _ = get_coverages_and_descriptions_sets(this_zip)
-        other_files, _ = get_coverages_and_descriptions_sets(other_zip)
-        assert len(this_files & other_files) > 0, "\n".join([
-            "Archives need to have at least one common dataset file to be comparable",
-            f"    {this_files=}",
-            f"    {other_files=}",
-        ])
-
-        # Let's skip files belonging to categories (coverage types) that we won't be comparing.
-        filter_files = lambda files: set(
-                file_path for file_path in files
-                if any(cat in file_path for cat in categories)
-        )
-        this_files = filter_files(this_files)
-        other_files = filter_files(other_files)
-
-        for common_file in this_files & other_files:
-            stream_pairs[extract_file_name(common_file)] = (unzip_to_stream(this_zip, common_file, path_this), unzip_to_stream(other_zip, common_file, path_other))
-        for this_only_file in this_files - other_files:
-            stream_pairs[extract_file_name(this_only_file)] = (unzip_to_stream(this_zip, this_only_file, path_this), Stream(path=path_other))
-        for other_only_file in other_files - this_files:
-            stream_pairs[extract_file_name(other_only_file)] = (Stream(path=path_this), unzip_to_stream(other_zip, other_only_file, path_other))
-
-    return stream_pairs
+        dataset_pairs = get_dataset_pairs(this_zip, other_zip, categories)
+
+    # Datasets are independent so they are parsed in parallel, each in a separate process.
+    names = list(dataset_pairs.keys())
+    paths = [path_this, path_other] * len(names)
+    files = [file for name in names for file in dataset_pairs[name]]
+    with ProcessPoolExecutor() as executor:
+        hit_counts = list(executor.map(load_hit_counts_from_zip, paths, files))
+    return {name: (hit_counts[2 * i], hit_counts[2 * i + 1]) for i, name in enumerate(names)}
 
 def main(args: argparse.Namespace):
     assert len(args.inputs) == 2,  "Currently only comparision between 2 files is supported"
@@ -380,7 +449,6 @@ def main(args: argparse.Namespace):
     assert len(categories) > 0, \
         f"Skipping all supported coverage types was requested but at least one of them has to be left to compare: {skipped_categories}"
 
-    stream_pairs = {}
     path_this, path_other = args.inputs[0], args.inputs[1]
     print(f"Comparing {path_this} against {path_other}")
 
@@ -388,25 +456,30 @@ def main(args: argparse.Namespace):
         return path.endswith(f".{expected_extension}")
 
     if all([extension_equals(x, "info") for x in args.inputs]):
-        stream_this, stream_other = Stream(path=path_this), Stream(path=path_other)
+        stream_this, stream_other = CoverageStream(path=path_this), CoverageStream(path=path_other)
         with open(path_this, 'rt') as f_this, open(path_other, 'rt') as f_other:
             stream_this.load(f_this)
             stream_other.load(f_other)
-        stream_pairs[f"{extract_file_name(path_this)}..{extract_file_name(path_other)}"] = (stream_this, stream_other)
+        hit_count_pairs = {f"{extract_file_name(path_this)}..{extract_file_name(path_other)}": (stream_this.hit_counts, stream_other.hit_counts)}
     elif all([extension_equals(x, "zip") for x in args.inputs]):
-        stream_pairs = unpack_existing_into_stream_pairs(path_this, path_other, categories)
+        hit_count_pairs = load_hit_count_pairs_from_zips(path_this, path_other, categories)
     else:
         raise Exception("Wrong files format. Both files must have the same extension. Supported extensions: `info` ,`zip`")
 
     if args.only_summary:
-        assert len(categories) > 1 and len(stream_pairs) > 1, \
+        assert len(categories) > 1 and len(hit_count_pairs) > 1, \
             "The `--only-summary` option isn't supported when comparing only one coverage type or one pair of files" + \
-            f" (requested coverage types: {categories}, {stream_pairs=})"
-    else:
-        for name in sorted(stream_pairs.keys()):
-            this, other = stream_pairs[name]
-            report_changes(args.table, args.markdown, name, this, other, args.output_all, args.report_missing)
-
-    if len(stream_pairs) > 1:
+            f" (requested coverage types: {categories}, datasets: {list(hit_count_pairs.keys())})"
+
+    # Compare each pair only once, the results are reused by the summary
+    comparisons: dict[str, list[CoverageCompare]] = {}
+    for name in sorted(hit_count_pairs.keys()):
+        this, other = hit_count_pairs[name]
+        # Ordering by file names is only needed when results are reported per file
+        comparisons[name] = compare_records(name, this, other, sort=not args.only_summary)
+        if not args.only_summary:
+            report_changes(args.table, args.markdown, name, path_this, path_other, comparisons[name], args.output_all, args.report_missing)
+
+    if len(hit_count_pairs) > 1:
         print("# Summary")
-        summary_with_categories(args.table, args.markdown, stream_pairs, categories)
+        summary_with_categories(args.table, args.markdown, comparisons, categories)
@@ -3,11 +3,13 @@
 
 import argparse
 from collections import defaultdict
-from .parser import Stream, Record, CategoryHandler, split_da, split_brda
+from .parser import Stream, Record, CategoryHandler, READ_BUFFER_SIZE, split_da, split_brda
 from . import handlers
 from typing import Optional
 
 COND_PREFIXES = ['cond']
+# Known entry types, the ones which aren't extracted are dropped while loading
+INFO_PREFIXES = ['SF', 'FN', 'FNDA', 'FNF', 'FNH', 'BRDA', 'BRF', 'BRH', 'DA', 'LF', 'LH']
 
 def create_prefix_filter(allowed: set[str]) -> CategoryHandler:
     def handler(prefix: str, data: list[str], file: Record) -> list[str]:
@@ -17,25 +19,38 @@ def create_prefix_filter(allowed: set[str]) -> CategoryHandler:
 
     return handler
 
+def drop_entry(prefix: str, params: str, file: Record) -> None:
+    return None
+
+def install_prefix_filter(stream: Stream, allowed: set[str]):
+    # Dropping entries as soon as they are read avoids keeping them in memory until saving.
+    # Entries of unknown types can't be dropped this way, so they are filtered out when saving.
+    stream.install_handler([prefix for prefix in INFO_PREFIXES if prefix not in allowed], drop_entry)
+    stream.install_generic_category_handler(create_prefix_filter(allowed))
+
 def install_branch_filters(stream: Stream, prefixes: list[str], filter_out=False):
     # Stores lines containing accepted BRDA entries for each Record.
     # This is later used to filter out DA entries that don't have
     # BRDA entries on the same line.
     brda_lines: dict[Record, set[int]] = defaultdict(set)
+    # `str.startswith` accepts a tuple of prefixes and checks all of them in a single call.
+    # A single prefix (the default) is passed as is, to skip iterating over a tuple.
+    prefixes = prefixes[0] if len(prefixes) == 1 else tuple(prefixes)
 
     def filter_brda(prefix: str, params: str, file: Record) -> Optional[str]:
         line, _, name, _ = split_brda(params)
-        if filter_out != any(name.startswith(p) for p in prefixes):
+        if filter_out != name.startswith(prefixes):
             brda_lines[file].add(line)
             return params
         return None
 
     def filter_da(prefix: str, data: list[str], file: Record) -> list[str]:
-        return [da for da in data if split_da(da)[0] in brda_lines[file]]
+        lines = brda_lines.get(file, ())
+        return [da for da in data if split_da(da)[0] in lines]
 
     stream.install_handler(['BRDA'], filter_brda)
     stream.install_category_handler(['DA'], filter_da)
-    stream.install_generic_category_handler(create_prefix_filter({'SF', 'DA', 'BRDA'}))
+    install_prefix_filter(stream, {'SF', 'DA', 'BRDA'})
 
 def prepare_args(parser: argparse.ArgumentParser):
     parser.add_argument('input', type=str,
@@ -48,10 +63,10 @@ def prepare_args(parser: argparse.ArgumentParser):
                         'Otherwise that BRDA entry is considered to be a "branch".')
 
 def main(args: argparse.Namespace):
-    stream = Stream()
+    stream = Stream(track_line_info=False)
 
     if args.coverage_type == 'line':
-        stream.install_generic_category_handler(create_prefix_filter({'SF', 'DA'}))
+        install_prefix_filter(stream, {'SF', 'DA'})
     elif args.coverage_type == 'branch':
         install_branch_filters(stream, COND_PREFIXES, filter_out=True)
     elif args.coverage_type == 'cond':
@@ -64,7 +79,7 @@ def main(args: argparse.Namespace):
     stream.install_category_handler(['LF'], handlers.create_count_restore('DA'))
     stream.install_category_handler(['LH'], handlers.create_hit_count_restore('DA'))
 
-    with open(args.input, 'rt') as f:
+    with open(args.input, 'rt', buffering=READ_BUFFER_SIZE) as f:
         stream.load(f)
 
     with open(args.output, 'wt') as f:
@@ -5,7 +5,7 @@ from .parser import CategoryHandler, Record
 
 def create_count_restore(prefix: str) -> CategoryHandler:
     def handler(_: str, entries: list[str], record: Record) -> list[str]:
-        count = 0 if prefix not in record.lines_per_prefix else len(record.lines_per_prefix[prefix])
+        count = len(record.lines_per_prefix.get(prefix, ()))
         return [str(count)]
     return handler
 
@@ -14,8 +14,12 @@ def create_hit_count_restore(prefix: str) -> CategoryHandler:
         count = 0
         if prefix in record.lines_per_prefix:
             for entry in record.lines_per_prefix[prefix]:
-                *_, hit_count = entry.rsplit(',', 1)
-                hit_count = 0 if hit_count == '-' else int(hit_count)
-                count += 1 if hit_count > 0 else 0
+                hit_count = entry[entry.rfind(',') + 1:]
+                if hit_count.isascii() and hit_count.isdigit():
+                    # Plain numbers are only checked for being non-zero, without converting them
+                    if hit_count.lstrip('0'):
+                        count += 1
+                elif hit_count != '-' and int(hit_count) > 0:
+                    count += 1
         return [str(count)]
     return handler
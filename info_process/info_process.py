@@ -21,53 +21,30 @@ COMPARE_CMD = 'compare'
 ARCHIVE_DIFF_CMD = 'archive-diff'
 REPORT_CMD = 'report'
 
+# Subcommand name -> (module implementing it, help message)
+COMMANDS = {
+    TRANSFORM_CMD: (transform, 'Perform transformations on the provided .info file'),
+    MERGE_CMD: (merge, 'Merge multiple .info files into one'),
+    PACK_CMD: (pack, 'Pack coverage data into a zip file for viewing in Coverview'),
+    EXTRACT_CMD: (extract, 'Extract coverage type from a combined .info file into a separate file'),
+    WAIVE_CMD: (waive, 'Waive entries based on waiver file'),
+    COMPARE_CMD: (compare, 'Compare two .info or two .zip files'),
+    ARCHIVE_DIFF_CMD: (archive_diff, 'Create archive that contains diff between two archives'),
+    REPORT_CMD: (report, 'Generate a report summarizing coverage in .info files'),
+}
+
 def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest='command_name')
-    transform.prepare_args(
-        subparsers.add_parser(TRANSFORM_CMD,
-                              help='Perform transformations on the provided .info file'))
-    merge.prepare_args(
-        subparsers.add_parser(MERGE_CMD,
-                              help='Merge multiple .info files into one'))
-    pack.prepare_args(
-        subparsers.add_parser(PACK_CMD,
-                              help='Pack coverage data into a zip file for viewing in Coverview'))
-    extract.prepare_args(
-        subparsers.add_parser(EXTRACT_CMD,
-                              help='Extract coverage type from a combined .info file into a separate file'))
-    waive.prepare_args(
-        subparsers.add_parser(WAIVE_CMD,
-                              help='Waive entries based on waiver file'))
-    compare.prepare_args(
-        subparsers.add_parser(COMPARE_CMD,
-                              help='Compare two .info or two .zip files'))
-    archive_diff.prepare_args(
-        subparsers.add_parser(ARCHIVE_DIFF_CMD,
-                              help='Create archive that contains diff between two archives'))
-    report.prepare_args(
-        subparsers.add_parser(REPORT_CMD,
-                              help='Generate a report summarizing coverage in .info files'))
+    for name, (module, help_message) in COMMANDS.items():
+        module.prepare_args(subparsers.add_parser(name, help=help_message))
 
     args = parser.parse_args()
 
     cmd = args.command_name
-    if cmd == TRANSFORM_CMD:
-        transform.main(args)
-    elif cmd == MERGE_CMD:
-        merge.main(args)
-    elif cmd == PACK_CMD:
-        pack.main(args)
-    elif cmd == EXTRACT_CMD:
-        extract.main(args)
-    elif cmd == WAIVE_CMD:
-        waive.main(args)
-    elif cmd == COMPARE_CMD:
-        compare.main(args)
-    elif cmd == ARCHIVE_DIFF_CMD:
-        archive_diff.main(args)
-    elif cmd == REPORT_CMD:
-        report.main(args)
-    else:
+    if cmd not in COMMANDS:
         print(f'Invalid subcommand: {cmd}')
         sys.exit(1)
+
+    module, _ = COMMANDS[cmd]
+    module.main(args)
@@ -3,11 +3,12 @@
 
 import argparse
 from . import handlers
-from .parser import Stream, Record, split_brda, split_da, EntryHandler
+from .parser import Stream, Record, split_brda, split_da, EntryHandler, CategoryHandler, READ_BUFFER_SIZE
 import json
 import os.path
 import re
 import shutil
+from functools import lru_cache
 from io import TextIOWrapper
 from itertools import chain
 from typing import Generator, IO, TextIO, Optional, Union
@@ -20,78 +21,110 @@ Sources = dict[bytes, bytes]
 CoverviewStreams = dict[str, Stream]
 
 
-def create_merge_da_handler() -> EntryHandler:
-    cache: dict[tuple[Record, int], int] = {}
+def create_merge_da_handlers() -> tuple[EntryHandler, CategoryHandler]:
+    # Maps each merged line to the index of its entry, the accumulated hit count and whether
+    # it was merged with any other entry. Hit counts are only summed while merging, merged
+    # entries are formatted once by the returned category handler when the stream is saved.
+    # Entries are cached per record, so that no key tuple has to be built for each entry
+    cache: dict[Record, dict[int, list]] = {}
     def handler(prefix: str, params: str, record: Record) -> Optional[str]:
         own_line_number, own_hit_count = split_da(params)
-        cache_key = (record, own_line_number)
-        lines = record.lines_per_prefix.get(prefix, [])
-
-        if cache_key not in cache:
-            cache[cache_key] = len(lines)
+        if (record_cache := cache.get(record)) is None:
+            record_cache = cache[record] = {}
+
+        if (merged := record_cache.get(own_line_number)) is None:
+            # An empty tuple is a constant, unlike `[]` which would allocate a new list on each call.
+            # The prefix can't be added here (e.g. with `setdefault`), as the record has to register
+            # it in `prefix_order` once the entry is added.
+            record_cache[own_line_number] = [len(record.lines_per_prefix.get(prefix, ())), own_hit_count, False]
             return params
 
-        entry_number = cache[cache_key]
-        line_number, hit_count = split_da(lines[entry_number])
-        assert line_number == own_line_number
-
-        lines[entry_number] = f'{own_line_number},{own_hit_count + hit_count}'
+        merged[1] += own_hit_count
+        merged[2] = True
         return None
 
-    return handler
-
-def create_merge_brda_handler() -> EntryHandler:
-    cache: dict[tuple[Record, int, str], int] = {}
+    def format_merged(prefix: str, entries: list[str], record: Record) -> list[str]:
+        if (record_cache := cache.get(record)) is not None:
+            lines = record.lines_per_prefix['DA']
+            for line_number, merged in record_cache.items():
+                entry_number, hit_count, is_merged = merged
+                if is_merged:
+                    lines[entry_number] = f'{line_number},{hit_count}'
+                    merged[2] = False
+        return entries
+
+    return handler, format_merged
+
+def create_merge_brda_handlers() -> tuple[EntryHandler, CategoryHandler]:
+    # Maps each merged entry to its index, the highest block number, the accumulated hit count
+    # and whether it was merged with any other entry, see `create_merge_da_handlers`
+    cache: dict[Record, dict[tuple[int, str], list]] = {}
     def handler(prefix: str, params: str, record: Record) -> Optional[str]:
         own_line_number, own_block, own_name, own_hit_count = split_brda(params)
-        cache_key = (record, own_line_number, own_name)
-        lines = record.lines_per_prefix.get(prefix, [])
+        if (record_cache := cache.get(record)) is None:
+            record_cache = cache[record] = {}
+        cache_key = (own_line_number, own_name)
 
-        if cache_key not in cache:
-            cache[cache_key] = len(lines)
+        if (merged := record_cache.get(cache_key)) is None:
+            record_cache[cache_key] = [len(record.lines_per_prefix.get(prefix, ())), own_block, own_hit_count, False]
             return params
 
-        entry_number = cache[cache_key]
-        line_number, block, name, hit_count = split_brda(lines[entry_number])
-        assert line_number == own_line_number
-        assert name == own_name
-
-        lines[entry_number] = f'{own_line_number},{max(block, own_block)},{own_name},{own_hit_count + hit_count}'
+        if own_block > merged[1]:
+            merged[1] = own_block
+        merged[2] += own_hit_count
+        merged[3] = True
         return None
 
-    return handler
+    def format_merged(prefix: str, entries: list[str], record: Record) -> list[str]:
+        if (record_cache := cache.get(record)) is not None:
+            lines = record.lines_per_prefix['BRDA']
+            for (line_number, name), merged in record_cache.items():
+                entry_number, block, hit_count, is_merged = merged
+                if is_merged:
+                    lines[entry_number] = f'{line_number},{block},{name},{hit_count}'
+                    merged[3] = False
+        return entries
+
+    return handler, format_merged
 
 def sort_da(prefix: str, entries: list[str], record: Record) -> list[str]:
+    # Entries are already merged at this point, so only line numbers have to be parsed.
+    # They usually come in an almost sorted order, which Timsort handles in linear time.
     def key(value: str) -> int:
-        line_number, _ = split_da(value)
-        return line_number
+        return int(value.split(',', 1)[0])
     entries.sort(key=key)
     return entries
 
 def sort_brda(prefix: str, entries: list[str], record: Record) -> list[str]:
+    # Entries from each merged file form already sorted runs which Timsort merges
+    # without a full sort, so the key is kept as cheap as possible
     def key(value: str) -> tuple[int, int]:
-        line_number, block, _, _ = split_brda(value)
-        return (line_number, block)
+        line_number, block, _ = value.split(',', 2)
+        return (int(line_number), int(block))
     entries.sort(key=key)
     return entries
 
+BRDA_NAME_NUMBER_REGEX = re.compile('[0-9]+')
+BRDA_NAME_FILL_SIZE = 20
+
+# The same names (e.g. toggles of each bit of a signal) repeat across many lines and records,
+# so expansions are cached to avoid scanning them with a regex on every sort
+@lru_cache(maxsize=None)
+def expand_brda_name(name: str) -> str:
+    def convert(match: re.Match) -> str:
+        value = match.group(0)
+        assert len(value) <= BRDA_NAME_FILL_SIZE, f'Number larger than 10^{BRDA_NAME_FILL_SIZE} encountered'
+        # Expand numbers encountered in names with leading zeros to make lexicographical
+        # sorting order them correctly. E.g. `toggle_10_1` will be expanded to
+        # `toggle_0000000010_0000000000` ordering it correctly after `toggle_2_0`
+        return value.zfill(BRDA_NAME_FILL_SIZE)
+
+    return BRDA_NAME_NUMBER_REGEX.sub(convert, name)
+
 def sort_brda_names(prefix: str, entries: list[str], record: Record) -> list[str]:
-    def convert(value: str) -> str:
-        FILL_SIZE = 20
-        if value.isdigit():
-            assert len(value) <= FILL_SIZE, f'Number larger than 10^{FILL_SIZE} encountered'
-            # Expand numbers encountered in names with leading zeros to make lexicographical
-            # sorting order them correctly. E.g. `toggle_10_1` will be expanded to
-            # `toggle_0000000010_0000000000` ordering it correctly after `toggle_2_0`
-            return value.zfill(FILL_SIZE)
-        else:
-            return value
-
-    SPLIT_REGEX = re.compile('([0-9]+)')
-    def key(value: str) -> tuple[int, list[Union[str, int]]]:
-        line_number, _, name, _ = split_brda(value)
-        name = ''.join(convert(x) for x in SPLIT_REGEX.split(name))
-        return (line_number, name)
+    def key(value: str) -> tuple[int, str]:
+        line_number, _, name, _ = value.split(',', 3)
+        return (int(line_number), expand_brda_name(name))
 
     entries.sort(key=key)
     return entries
@@ -102,50 +135,49 @@ def squash_misc(prefix: str, entries: list[str], record: Record) -> list[str]:
     return [entries[0]]
 
 def create_test_list(out: TextIO, stream: Stream):
+    # Each record is written with a single call, as each `write` call on a text stream
+    # has a noticeable overhead compared to the short lines written here
     out.write('TN:test_coverage\n')
     for record in stream.records.values():
         merged: dict[int, set[str]] = {}
         for prefix in ['DA', 'BRDA']:
-            if prefix not in record.line_info:
-                continue
-
-            for line, info in record.line_info[prefix].items():
-                if line in merged:
-                    merged[line].update(info.test_files)
-                else:
-                    merged[line] = info.test_files.copy()
-
-        out.write(f'SN:{record.source_file}\n')
-        for line in sorted(merged.keys()):
-            if len(merged[line]) == 0:
-                continue
+            for line, info in record.line_info.get(prefix, {}).items():
+                merged.setdefault(line, set()).update(info.test_files)
+
+        output: list[str] = [f'SN:{record.source_file}\n']
+        output.extend(
+            f'TEST:{line},{";".join(sorted(test_files))}\n'
+            for line, test_files in sorted(merged.items())
+            if len(test_files) > 0
+        )
+        output.append('end_of_record\n')
+        out.write(''.join(output))
 
-            out.write(f'TEST:{line},')
-            out.write(';'.join(sorted(merged[line])))
-            out.write('\n')
-        out.write('end_of_record\n')
-    
-def strip_test_name_regex(test_name, pattern):
-    regex = re.compile(pattern)
+def remove_matched_groups(match: re.Match) -> str:
+    groups = match.groups()
 
-    def repl(match: re.Match) -> str:
-        groups = match.groups()
+    if not any(groups):
+        return ""
 
-        if not any(groups):
-            return ""
+    out = match.group(0)
+    for g in groups:
+        if g is not None:
+            out = out.replace(g, "")
+    return out
 
-        out = match.group(0)
-        for g in groups:
-            if g is not None:
-                out = out.replace(g, "")
-        return out
+@lru_cache(maxsize=None)
+def compile_regex_strip_pattern(pattern: str) -> re.Pattern:
+    # The same pattern is used for all input files, so compile it only once
+    return re.compile(pattern)
 
-    return regex.sub(repl, test_name)
+def strip_test_name_regex(test_name, pattern):
+    return compile_regex_strip_pattern(pattern).sub(remove_matched_groups, test_name)
 
 
 def strip_test_name_simple(test_name, pattern):
+    # Substrings are removed one after another, so a later one can match text joined by removing an earlier one
     for string in pattern.split(','):
-            test_name = test_name.replace(string, '')
+        test_name = test_name.replace(string, '')
     return test_name
 
 def prepare_args(parser: argparse.ArgumentParser):
@@ -195,9 +227,15 @@ def setup_info_stream(stream: Stream, args: argparse.Namespace) -> Stream:
     # NOTE: All regular handlers for `BRDA` and `DA` entries
     # should be placed BEFORE those two, as they make assumptions
     # about the order and amount of entries!!!
-    stream.install_handler(['BRDA'], create_merge_brda_handler())
-    stream.install_handler(['DA'], create_merge_da_handler())
-
+    merge_brda, format_merged_brda = create_merge_brda_handlers()
+    merge_da, format_merged_da = create_merge_da_handlers()
+    stream.install_handler(['BRDA'], merge_brda)
+    stream.install_handler(['DA'], merge_da)
+
+    # Merged entries have to be formatted before they are sorted or their hits are counted,
+    # regardless of whether the record lists the entries or their summaries first
+    stream.install_category_handler(['BRDA', 'BRH'], format_merged_brda)
+    stream.install_category_handler(['DA', 'LH'], format_merged_da)
     stream.install_category_handler(['BRDA'], sort_brda_names if args.sort_brda_names else sort_brda)
     stream.install_category_handler(['DA'], sort_da)
     stream.install_category_handler(['BRF'], handlers.create_count_restore('BRDA'))
@@ -211,23 +249,24 @@ def setup_info_stream(stream: Stream, args: argparse.Namespace) -> Stream:
 
 def merge_info_files(args: argparse.Namespace):
     stream = setup_info_stream(Stream(), args)
+    inputs = sorted(args.inputs)
     if args.test_list is not None:
         # os.path.commonpath is used instead of os.path.commonprefix to prevent automatic removal
         # of parts of file names. It doesn't include the final '/' though so we need to add it.
-        common_prefix = '' if args.test_list_full_path else os.path.commonpath(args.inputs) + '/'
+        common_prefix = '' if args.test_list_full_path else os.path.commonpath(inputs) + '/'
 
     strip_test_name = \
         strip_test_name_simple if args.test_list_strip_mode == "simple" \
         else strip_test_name_regex
-    
+
     print('Merging input files...')
-    for path in sorted(args.inputs):
+    for path in inputs:
         print(path)
         test_name = None
         if args.test_list is not None:
             test_name = path.removeprefix(common_prefix)
-            test_name = strip_test_name(test_name,args.test_list_strip)
-        with open(path, 'rt') as f:
+            test_name = strip_test_name(test_name, args.test_list_strip)
+        with open(path, 'rt', buffering=READ_BUFFER_SIZE) as f:
             stream.merge(f, test_name)
 
     print(f'Saving merge output in {args.output}')
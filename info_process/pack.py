@@ -2,23 +2,25 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import codecs
 import itertools
 import json
 import os
-from .parser import Stream, Record
+from .parser import READ_BUFFER_SIZE
 import re
 import shutil
 import sys
-from typing import TypedDict, Optional, Union, Iterable
+from typing import BinaryIO, TypedDict, Optional, Union, Iterable
 from zipfile import ZipFile, ZIP_DEFLATED
 
 Datasets = dict[str, dict[str, Union[str, list[str]]]]
+Sources = list[tuple[str, str]]
 
 class CoverviewConfig(TypedDict):
     datasets: Datasets
     table_coverage: Optional[str]
 
-INFO_PATTERN = re.compile(r'coverage_(?P<coverage_type>\w+)_(?P<dataset>\w+).info')
+INFO_PATTERN = re.compile(r'coverage_(?P<coverage_type>\w+)_(?P<dataset>\w+)\.info')
 
 # Returns (coverage_type: str, dataset: str) | None
 def extract_type_and_dataset(path: str) -> Optional[tuple[str, str]]:
@@ -30,6 +32,9 @@ def extract_type_and_dataset(path: str) -> Optional[tuple[str, str]]:
 def generate_datasets(coverage_files: list[str], description_files: list[str]) -> Datasets:
     working_datasets = Datasets()
 
+    # Basenames of description files, to match them with coverage files
+    description_basenames = {os.path.basename(description_path) for description_path in description_files}
+
     # Find .info files
     for path in coverage_files:
         basename = os.path.basename(path)
@@ -45,10 +50,8 @@ def generate_datasets(coverage_files: list[str], description_files: list[str]) -
 
         # Find a matching .desc file
         description_basename = f'tests_{coverage_type}_{dataset}.desc'
-        for description_path in description_files:
-            if os.path.basename(description_path) == description_basename:
-                working_datasets[dataset][coverage_type] = [basename, description_basename]
-                break
+        if description_basename in description_basenames:
+            working_datasets[dataset][coverage_type] = [basename, description_basename]
         else:
             working_datasets[dataset][coverage_type] = basename
             print(f'WARNING: Coverage file does not have a matching test description file ({description_basename}): {basename}')
@@ -79,6 +82,14 @@ def get_coverage_description_paired_files(config: CoverviewConfig, available_cov
     # Second parameter is optional as it is possible to pack an .info file without a corresponding .desc file
     coverage_description_pairs: list[tuple[str, Optional[str]]] = []
 
+    # Maps basenames to paths, the first path with a given basename is used
+    coverages_by_basename: dict[str, str] = {}
+    for coverage_file in available_coverages:
+        coverages_by_basename.setdefault(os.path.basename(coverage_file), coverage_file)
+    descriptions_by_basename: dict[str, str] = {}
+    for description_file in available_descriptions:
+        descriptions_by_basename.setdefault(os.path.basename(description_file), description_file)
+
     for dataset in config['datasets'].values():
         for file in dataset.values():
             # This may also be a list of strings in cases where a .info file is paired with a .desc file
@@ -95,20 +106,14 @@ def get_coverage_description_paired_files(config: CoverviewConfig, available_cov
                 else:
                     print(f'ERROR: Invalid dataset files: {file}; only pairs of .info and .desc files are allowed')
 
-            for coverage_file in available_coverages:
-                if os.path.basename(coverage_file) == coverage_file_basename:
-                    found_coverage_file = coverage_file
-                    break
-            else:
+            found_coverage_file = coverages_by_basename.get(coverage_file_basename)
+            if found_coverage_file is None:
                 print(f'ERROR: Coverage file not found: {coverage_file_basename}')
                 sys.exit(1)
 
             if description_file_basename is not None:
-                for description_file in available_descriptions:
-                    if os.path.basename(description_file) == description_file_basename:
-                        found_description_file = description_file
-                        break
-                else:
+                found_description_file = descriptions_by_basename.get(description_file_basename)
+                if found_description_file is None:
                     print(f'ERROR: Description file not found: {description_file_basename}')
                     sys.exit(1)
             else:
@@ -118,51 +123,75 @@ def get_coverage_description_paired_files(config: CoverviewConfig, available_cov
 
     return coverage_description_pairs
 
-def get_sources(coverage_files: list[str], root: Optional[str]) -> str:
+# Returns (path from the SF entry, path to the file) pairs
+def get_sources(coverage_files: list[str], root: Optional[str]) -> Sources:
     found_files: set[str] = set()
-    def save_path_handler(prefix: str, path: str, record: Record) -> str:
-        found_files.add(path)
-        return path
-
     for file_path in coverage_files:
-        stream = Stream()
-        stream.install_handler(['SF'], save_path_handler)
-        with open(file_path, 'rt') as file:
-            stream.load(file)
-
-    sources: list[str] = []
-    for source_file in sorted(found_files):
-        os_path = source_file if root is None else os.path.join(root, source_file)
+        # Only paths from SF entries are needed, so there's no need to parse whole records
+        with open(file_path, 'rt', buffering=READ_BUFFER_SIZE) as file:
+            for line in file:
+                if line.startswith('SF:'):
+                    found_files.add(line[3:].strip())
+
+    return [
+        (source_file, source_file if root is None else os.path.join(root, source_file))
+        for source_file in sorted(found_files)
+    ]
+
+def check_sources(sources: Sources):
+    # Called before the previous output is removed, so that it's kept if any source can't be packed
+    for _, os_path in sources:
+        # Only valid UTF-8 files can be packed, chunks are decoded incrementally
+        # as they may end in the middle of a multibyte character
+        decoder = codecs.getincrementaldecoder('utf-8')()
         try:
-            # Use 'rb' to prevent Python from converting '\r\n' into '\n'
             with open(os_path, 'rb') as file:
-                sources.append(f'### FILE: {source_file}\n')
-                sources.append(file.read().decode('utf-8'))
+                while chunk := file.read(READ_BUFFER_SIZE):
+                    decoder.decode(chunk)
+            decoder.decode(b'', final=True)
         except OSError as e:
             print(f'ERROR: Source file could not be opened: {os_path} ({e})')
             sys.exit(1)
+        except UnicodeDecodeError as e:
+            print(f'ERROR: Source file is not a valid UTF-8 file: {os_path} ({e})')
+            sys.exit(1)
+
+def write_sources(output: BinaryIO, sources: Sources):
+    # Sources are copied in chunks, so that memory usage doesn't depend on their size
+    for source_file, os_path in sources:
+        output.write(f'### FILE: {source_file}\n'.encode('utf-8'))
+        # Use 'rb' to prevent Python from converting '\r\n' into '\n'
+        with open(os_path, 'rb') as file:
+            shutil.copyfileobj(file, output, READ_BUFFER_SIZE)
 
-    return ''.join(sources)
+def pack_zip(output: str, config: CoverviewConfig, sources: Optional[Sources], files_to_pack: Iterable[str], compression_level: Optional[int] = None):
+    if sources is not None:
+        check_sources(sources)
 
-def pack_zip(output: str, config: CoverviewConfig, sources: Optional[str], files_to_pack: Iterable[str]):
     # Remove previous archive, if it exists to not mixup any files
     if os.path.isfile(output):
         print(f'Removing previous output archive: {output}')
         os.remove(output)
 
-    with ZipFile(output, 'x', compression=ZIP_DEFLATED) as archive:
+    # `None` uses zlib's default compression level
+    with ZipFile(output, 'x', compression=ZIP_DEFLATED, compresslevel=compression_level) as archive:
         # Write the config
         archive.writestr('config.json', json.dumps(config, indent=2))
 
         # Write combined sources if provided
         if sources is not None:
-            archive.writestr('sources.txt', sources)
+            # The final size isn't known upfront, so allow it to exceed the limit of a regular entry
+            with archive.open('sources.txt', 'w', force_zip64=True) as file:
+                write_sources(file, sources)
 
         # Copy all files (coverage, description and extra files)
         for file in files_to_pack:
             archive.write(file, os.path.basename(file))
 
-def pack_directory(output: str, config: CoverviewConfig, sources: Optional[str], files_to_pack: Iterable[str]):
+def pack_directory(output: str, config: CoverviewConfig, sources: Optional[Sources], files_to_pack: Iterable[str]):
+    if sources is not None:
+        check_sources(sources)
+
     # Remove the previous directory, if it exists to not mixup any files
     if os.path.isdir(output):
         print(f'Removing previous output directory: {output}')
@@ -177,7 +206,7 @@ def pack_directory(output: str, config: CoverviewConfig, sources: Optional[str],
     # File is opened as binary to prevent Python from modifying line end characters
     if sources is not None:
         with open(os.path.join(output, 'sources.txt'), 'wb') as file:
-            file.write(sources.encode('utf-8'))
+            write_sources(file, sources)
 
     # Copy all files (coverage, description and extra files)
     for file in files_to_pack:
@@ -202,6 +231,9 @@ def prepare_args(parser: argparse.ArgumentParser):
                         'from files provided in --coverage-files and --description-files')
     parser.add_argument('--generate-tables', type=str, default=None,
                         help='Coverage type, for which tables should be generated in the Coverview dashboard')
+    parser.add_argument('--compression-level', type=int, choices=range(10), default=None, metavar='{0-9}',
+                        help='Compression level of the output .zip archive, 1 is the fastest and 9 compresses the most; ' +
+                        'default: zlib\'s default (6)')
 
 def main(args: argparse.Namespace):
     with open(args.config, 'rt') as f:
@@ -222,7 +254,7 @@ def main(args: argparse.Namespace):
     all_files = (f for f in itertools.chain(used_coverage, used_descriptions, args.extra_files) if f is not None)
     if args.output.lower().endswith('.zip'):
         print(f'Creating an output .zip archive: {args.output}')
-        pack_zip(args.output, config, sources, all_files)
+        pack_zip(args.output, config, sources, all_files, args.compression_level)
     else:
         print(f'Creating an output directory: {args.output}')
         pack_directory(args.output, config, sources, all_files)
@@ -5,6 +5,8 @@ import itertools
 from typing import TextIO, Callable, Iterable, Generator, Any, Union, Optional
 
 END_OF_RECORD = 'end_of_record'
+# .info files can get very large, so read them in bigger chunks than the default 8 KiB
+READ_BUFFER_SIZE = 1 << 20
 
 # Returning `None` causes the processed entry to be removed from the record
 EntryHandler = Callable[[str, str, 'Record'], Union[Iterable[str], str, None]]
@@ -13,21 +15,36 @@ CategoryHandler = Callable[[str, list[str], 'Record'], list[str]]
 class RemoveRecord(Exception):
     pass
 
+# Shared by all lines without test files, so that a set is only created for lines with hits
+NO_TEST_FILES: frozenset[str] = frozenset()
+
 class LineInfo:
+    # One instance is created for each DA and BRDA line, so avoid per-instance dicts
+    __slots__ = ('test_files',)
+
     def __init__(self, initial_file: Optional[str]):
-        self.test_files: set[str] = set()
-        self.add_source(initial_file)
+        self.test_files: Union[set[str], frozenset[str]] = NO_TEST_FILES if initial_file is None else {initial_file}
 
     def add_source(self, test_file: Optional[str]):
         if test_file is not None:
-            self.test_files.add(test_file)
+            if self.test_files is NO_TEST_FILES:
+                self.test_files = {test_file}
+            else:
+                self.test_files.add(test_file)
+
+    def add_sources(self, other: 'LineInfo'):
+        if other.test_files:
+            if self.test_files is NO_TEST_FILES:
+                self.test_files = set(other.test_files)
+            else:
+                self.test_files.update(other.test_files)
 
 def split_entry(entry: str) -> tuple[str, str]:
     prefix, data = entry.split(':', 1)
     return (prefix, data)
 
 def split_da(entry: str) -> tuple[int, int]:
-    line_number, hit_count = entry.split(',', 1)
+    line_number, _, hit_count = entry.partition(',')
 
     line_number = int(line_number)
     assert line_number >= 0
@@ -60,7 +77,9 @@ def split_test(entry: str) -> tuple[int, list[str]]:
     return line_number, tests.split(';')
 
 def get_line_number_and_hit_count(entry: str) -> tuple[int, int]:
-    line_number, *_, hit_count = entry.split(',')
+    # Only the first and the last field are needed, so don't split the whole entry
+    line_number = entry[:entry.index(',')]
+    hit_count = entry[entry.rindex(',') + 1:]
 
     line_number = int(line_number)
     assert line_number >= 0
@@ -77,20 +96,9 @@ def match_second_entries_by(first, second):
 
     return result_dict
 
-def match_second_prefix_entries_by(first: 'Record', second: 'Record', prefix: str, key) -> dict[str, tuple[str]]:
-    if second is None or any([prefix not in x.lines_per_prefix for x in (first, second)]):
-        return {}
-
-    result_dict = {}
-    first_entries = {key(entry): entry for entry in first.lines_per_prefix[prefix]}
-    second_entries = {key(entry): entry for entry in second.lines_per_prefix[prefix]}
-
-    for name in second_entries.keys():
-        result_dict[name] = (first_entries.get(name, None), second_entries.get(name))
-
-    return result_dict
-
 class Record:
+    __slots__ = ('stream', 'source_file', 'lines_per_prefix', 'line_info', 'prefix_order', 'source_file_prefix', 'track_line_info')
+
     def __init__(self, stream: 'Stream'):
         self.stream = stream
         self.source_file: Optional[str] = None
@@ -98,6 +106,7 @@ class Record:
         self.line_info: dict[str, dict[int, LineInfo]] = {}
         self.prefix_order: list[str] = []
         self.source_file_prefix = self.stream.source_file_prefix
+        self.track_line_info = self.stream.track_line_info
 
     def diff(self, other: 'Record') -> 'Record':
         # diff entries:
@@ -108,117 +117,109 @@ class Record:
         #          !in_new                       -> skip line
         assert other is not None, "Should never diff against None"
 
-        class CoverageLine:
-            def __init__(self, line: str):
-                assert line is not None
-                base_string, hit_count = line.rsplit(',', 1)
-                self.line_hit = int(hit_count) > 0
-                self.base = base_string
-
-            @classmethod
-            def instance_or_none(cls, line: str):
-                if line is None:
-                    return None
-                return cls(line)
-
-            def __repr__(self) -> str:
-                return f"{self.base},{int(self.line_hit)}"
-
-        def keep_line(values: tuple[CoverageLine, CoverageLine]) -> bool:
-            old_line, new_line = values
-            if not old_line:
-                return True
-            return old_line.line_hit != new_line.line_hit
-
-        def new_value(values: tuple[CoverageLine]) -> str:
-            """ Asserts that lines have same bases, and retuns new_value. This assumes that lines are not equal"""
-            old_line, new_line = values
-
-            if old_line is not None:
-                assert old_line.base == new_line.base, "Cannot diff between different lines"
-            return str(new_line)
-
-        def match_coverage_lines_by(first: 'Record', second: 'Record', prefix: str, key) -> dict[str, tuple[CoverageLine]]:
-            source = match_second_prefix_entries_by(first, second, prefix, key)
-            return { k: (CoverageLine.instance_or_none(old), CoverageLine.instance_or_none(new)) for k, (old, new) in source.items()}
-
-        def generate_new_lines_from(first: 'Record', second: 'Record', prefix: str) -> list[str]:
-            if prefix not in other.lines_per_prefix:
+        def diff_entries(prefix: str) -> list[str]:
+            if (old_entries := self.lines_per_prefix.get(prefix)) is None or (new_entries := other.lines_per_prefix.get(prefix)) is None:
                 return []
-            else:
-                return [ new_value(values)
-                         for _, values
-                         in match_coverage_lines_by(first, second, prefix, key=lambda x: x.split(",")[0]).items()
-                         if keep_line(values)
-                ]
 
-        other.lines_per_prefix["DA"] = generate_new_lines_from(self, other, "DA")
-        other.lines_per_prefix["BRDA"] = generate_new_lines_from(self, other, "BRDA")
+            # Entries are matched by line number, the last entry for each line is used
+            old_by_line = {entry[:entry.index(',')]: entry for entry in old_entries}
+            new_by_line = {entry[:entry.index(',')]: entry for entry in new_entries}
+            lines = []
+            for line_number, new_entry in new_by_line.items():
+                old_entry = old_by_line.get(line_number)
+                # Split every matched entry only once into the base and the hit count
+                new_base, _, new_hit_count = new_entry.rpartition(',')
+                new_hit = int(new_hit_count) > 0
+                if old_entry is not None:
+                    old_base, _, old_hit_count = old_entry.rpartition(',')
+                    if (int(old_hit_count) > 0) == new_hit:
+                        continue
+                    assert old_base == new_base, "Cannot diff between different lines"
+                lines.append(f'{new_base},{int(new_hit)}')
+            return lines
+
+        other.lines_per_prefix["DA"] = diff_entries("DA")
+        other.lines_per_prefix["BRDA"] = diff_entries("BRDA")
 
         return other
 
-    def add(self, prefix: str, data: str):
-        if prefix in self.stream.handlers:
-            processed = self._run_handlers(self.stream.handlers[prefix], prefix, data)
-            if processed is None:
-                return
+    def add(self, prefix: str, data: str, has_stats: bool = False):
+        # Stats of entries read by the stream are already updated when their records are read
+        # (`has_stats`), so they only have to be updated for entries added or changed by handlers.
+        # Most prefixes usually have no handlers, so add their entries right after a single lookup
+        if (handlers := self.stream.handlers.get(prefix)) is None:
+            self._add_entry(prefix, data, not has_stats)
+            return
 
-            for entry in processed:
-                self._add_entry(prefix, entry)
-        else:
-            self._add_entry(prefix, data)
+        processed = self._run_handlers(handlers, prefix, data)
+        if processed is None:
+            return
 
-    def has_entries_for_line_number(self, line_number: str):
-        ret_val = any(line.startswith(f'{line_number},') for line in itertools.chain(*list(self.lines_per_prefix.values())))
-        return ret_val
+        for entry in processed:
+            self._add_entry(prefix, entry, not has_stats or entry != data)
 
     def has_entry_for_line(self, prefix: str, line: int) -> bool:
         assert type(line) is int
-        if prefix not in self.line_info:
-            return False
-        return line in self.line_info[prefix]
+        lines = self.line_info.get(prefix)
+        return lines is not None and line in lines
 
     def save(self, stream: TextIO):
-        stream.write(str(self))
+        stream.writelines(self._format())
 
     def __str__(self) -> str:
-        output: str = ""
+        return ''.join(self._format())
+
+    def _format(self) -> Generator[str, Any, None]:
+        lines_per_prefix = self.lines_per_prefix
+        category_handlers = self.stream.category_handlers
+        generic_category_handlers = self.stream.generic_category_handlers
         for prefix in self.prefix_order:
-            data = self.lines_per_prefix[prefix]
-            if prefix in self.stream.category_handlers:
-                handlers = itertools.chain(self.stream.category_handlers[prefix], self.stream.generic_category_handlers)
+            data = lines_per_prefix[prefix]
+            if (prefix_handlers := category_handlers.get(prefix)) is not None:
+                handlers = itertools.chain(prefix_handlers, generic_category_handlers)
             else:
-                handlers = self.stream.generic_category_handlers
+                handlers = generic_category_handlers
 
             for handler in handlers:
                 data = handler(prefix, data, self)
 
-            self.lines_per_prefix[prefix] = data
-            output += "\n".join(f'{prefix}:{line}' for line in self.lines_per_prefix[prefix])
-            if len(self.lines_per_prefix[prefix]) > 0:
-                output += "\n"
-        output += f'{END_OF_RECORD}'
-        return output
+            lines_per_prefix[prefix] = data
+            if len(data) > 0:
+                # Every entry is preceded by its prefix, so entries can be joined with the separator
+                yield f'{prefix}:'
+                yield f'\n{prefix}:'.join(data)
+                yield '\n'
+        yield END_OF_RECORD
 
     def _merge_stats(self, other: 'Record'):
-        for prefix in other.line_info:
-            if prefix not in self.line_info:
-                self.line_info[prefix] = other.line_info[prefix]
+        for prefix, other_lines in other.line_info.items():
+            if (lines := self.line_info.get(prefix)) is None:
+                self.line_info[prefix] = other_lines
                 continue
 
-            for line, info in other.line_info[prefix].items():
-                if line not in self.line_info[prefix]:
-                    self.line_info[prefix][line]  = info
-                    continue
-
-                self.line_info[prefix][line].test_files.update(info.test_files)
+            for line, info in other_lines.items():
+                if (own_info := lines.get(line)) is None:
+                    lines[line] = info
+                else:
+                    own_info.add_sources(info)
 
     def _run_handlers(self, handlers: list[EntryHandler], prefix: str, data: str):
+        # Handlers usually return a single entry, so run them on it directly
+        # until one of them returns multiple entries.
+        for index, handler in enumerate(handlers):
+            processed = handler(prefix, data, self)
+            if processed is None:
+                return None
+            if not isinstance(processed, str):
+                return self._run_handlers_on_entries(handlers[index + 1:], prefix, list(processed))
+            data = processed
+        return (data,)
+
+    def _run_handlers_on_entries(self, handlers: list[EntryHandler], prefix: str, result: list[str]):
         # Run all of the available handler for each of the provided data
         # Since handlers can return multiple values to duplicate entries,
         # the next handler has to be run on the full list of outputs
         # from the previous handler.
-        result = [data]
         for handler in handlers:
             transformed = []
             for x in result:
@@ -232,36 +233,38 @@ class Record:
             result = transformed
         return result
 
-    def _ensure_prefix(self, prefix: str):
-        if prefix not in self.lines_per_prefix:
+    def _ensure_prefix(self, prefix: str) -> list[str]:
+        if (lines := self.lines_per_prefix.get(prefix)) is None:
             # Order the sections in the same way as in the original file.
             # This is to an attempt to produce the smallest possible diff
             # between two .info files.
             self.prefix_order.append(prefix)
-            self.lines_per_prefix[prefix] = []
+            lines = self.lines_per_prefix[prefix] = []
+        return lines
 
-    def _add_entry(self, prefix: str, data: str):
-        self._ensure_prefix(prefix)
-        self.lines_per_prefix[prefix].append(data)
-        self._update_stats(prefix, data, None)
+    def _add_entry(self, prefix: str, data: str, update_stats: bool = True):
+        self._ensure_prefix(prefix).append(data)
+        if update_stats:
+            self._update_stats(prefix, data, None)
 
     def _update_stats(self, prefix: str, data: str, test_file: Optional[str]):
         if self.source_file is None and prefix == self.source_file_prefix:
             self.source_file = data
-        elif prefix == 'BRDA' or prefix == 'DA':
+        elif self.track_line_info and (prefix == 'BRDA' or prefix == 'DA'):
             line_number, hit_count = get_line_number_and_hit_count(data)
-            if prefix not in self.line_info:
-                self.line_info[prefix] = {}
+            # Keep the looked up dicts, this runs for every DA and BRDA entry
+            if (lines := self.line_info.get(prefix)) is None:
+                lines = self.line_info[prefix] = {}
 
             if hit_count == 0:
                 test_file = None
-            if line_number not in self.line_info[prefix]:
-                self.line_info[prefix][line_number] = LineInfo(test_file)
+            if (info := lines.get(line_number)) is None:
+                lines[line_number] = LineInfo(test_file)
             else:
-                self.line_info[prefix][line_number].add_source(test_file)
+                info.add_source(test_file)
 
 class Stream:
-    def __init__(self, source_file_prefix: str = "SF", path: Optional[str] = None):
+    def __init__(self, source_file_prefix: str = "SF", path: Optional[str] = None, track_line_info: bool = True):
         self.handlers: dict[str, list[EntryHandler]] = {}
         self.category_handlers: dict[str, list[CategoryHandler]] = {}
         self.generic_category_handlers: list[CategoryHandler] = []
@@ -269,6 +272,9 @@ class Stream:
         self.test_name: Optional[str] = None
         self.source_file_prefix = source_file_prefix
         self.path = path
+        # Line info is only used for test lists and line lookups,
+        # streams which don't need them can skip indexing every DA and BRDA entry
+        self.track_line_info = track_line_info
 
     def diff(self, other_stream: 'Stream') -> 'Stream':
         this_records, other_records = self.records, other_stream.records
@@ -308,7 +314,7 @@ class Stream:
         for record, lines in self._get_record_lines(stream, None):
             try:
                 for prefix, data in lines:
-                    record.add(prefix, data)
+                    record.add(prefix, data, has_stats=True)
                 record_list.append(record)
             except RemoveRecord:
                 pass
@@ -316,37 +322,33 @@ class Stream:
         # Convert the list to the record dict, by concatenating lines for
         # records with a matching source file
         for record in record_list:
-            if duplicate := self.records.get(record.source_file):
+            if (duplicate := self.records.setdefault(record.source_file, record)) is not record:
                 for prefix, lines in record.lines_per_prefix.items():
-                    duplicate._ensure_prefix(prefix)
-                    duplicate.lines_per_prefix[prefix].extend(lines)
-            else:
-                self.records[record.source_file] = record
+                    duplicate._ensure_prefix(prefix).extend(lines)
+                duplicate._merge_stats(record)
 
     def merge(self, stream: TextIO, test_file_path: str):
         for record, lines in self._get_record_lines(stream, test_file_path):
             record = self._get_matching_record(record)
             for prefix, data in lines:
                 try:
-                    record.add(prefix, data)
+                    record.add(prefix, data, has_stats=True)
                 except RemoveRecord:
                     print('Removing records is not supported during merging')
                     raise
 
-    def has_entries_for_source_file_line(self, source_file_name: str, line_number: str) -> bool:
-        record = self.records.get(source_file_name, None)
-        if record is None:
-            return False
-        return record.has_entries_for_line_number(line_number)
-
     def save(self, out: TextIO):
-        out.write(str(self))
+        # Write records one by one, so that the whole output doesn't have to be kept in memory
+        out.write(f"TN:{self.test_name or ''}\n")
+        for record in self.records.values():
+            record.save(out)
+            out.write("\n")
 
     def __str__(self) -> str:
-        output: str = ""
-        output += f"TN:{self.test_name or ''}\n"
-        output += "".join(str(record) + "\n" for record in self.records.values())
-        return output
+        output: list[str] = [f"TN:{self.test_name or ''}"]
+        output.extend(str(record) for record in self.records.values())
+        output.append('')
+        return '\n'.join(output)
 
     def _get_record_lines(self, stream: TextIO, test_file: Optional[str]) -> Generator[tuple[Record, list[tuple[str, str]]], Any, None]:
         record = Record(self)
@@ -354,28 +356,28 @@ class Stream:
         test_name = None  # This is per merged file, self.test_name is one for the output file.
         for line_num, line in enumerate(stream, start=1):
             line = line.strip()
-            if not line or line.startswith('#'):
+            if not line or line[0] == '#':
                 continue # Skip comments and empty lines
-            if line.startswith('TN:'):
+
+            # Split each line only once, END_OF_RECORD is the only valid line without a colon
+            prefix, separator, data = line.partition(':')
+            if not separator:
+                if line == END_OF_RECORD:
+                    yield (record, lines)
+                    lines = []
+                    record = Record(self)
+                else:
+                    print(f"Warning: Ignoring invalid line {line_num}: {line}")
+            elif prefix == 'TN':
                 if test_name:
                     print("WARNING: Multiple TN entries found")
-                test_name = line.removeprefix('TN:')
+                test_name = data
 
                 if self.test_name is None:
                     self.test_name = test_name
                 elif test_name != self.test_name:
                     print(f"WARNING: Different TN entry: {test_name}, first TN found was: {self.test_name}")
-                continue
-            if line == END_OF_RECORD:
-                yield (record, lines)
-                lines = []
-                record = Record(self)
             else:
-                try:
-                    prefix, data = split_entry(line)
-                except:
-                    print(f"Warning: Ignoring invalid line {line_num}: {line}")
-                    continue
                 record._update_stats(prefix, data, test_file)
                 lines.append((prefix, data))
 
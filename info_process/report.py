@@ -2,13 +2,17 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
-from dataclasses import dataclass, asdict, field
-from io import TextIOWrapper
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field, fields, is_dataclass
+from functools import partial
+from io import StringIO, TextIOWrapper
 import json
 import os
-from .parser import Stream, Record, EntryHandler, split_da, split_brda
+from operator import countOf
+from .parser import Stream, Record, EntryHandler, split_da, split_brda, READ_BUFFER_SIZE
 from .pack import extract_type_and_dataset, Datasets
-from typing import TextIO, Generator, Any, Union, Optional
+from typing import TextIO, Generator, Any, Iterable, Union, Optional
 from zipfile import ZipFile
 
 UNKNOWN_COVERAGE = 'unknown'
@@ -24,10 +28,21 @@ class GroupSummary:
     groups: dict[int, dict[str, int]] = field(default_factory=dict)
 
     def update_summary(self):
-        self.summary = Summary()
+        hit = total = 0
         for group in self.groups.values():
-            self.summary.hit += sum(1 if hit > 0 else 0 for hit in group.values())
-            self.summary.total += len(group)
+            # Hit counts can't be negative, so only the zeros have to be counted
+            hit += len(group) - countOf(group.values(), 0)
+            total += len(group)
+        self.summary = Summary(hit, total)
+
+    def merge(self, other: 'GroupSummary'):
+        for group, names in other.groups.items():
+            if (own_names := self.groups.get(group)) is None:
+                self.groups[group] = names
+                continue
+
+            for name, hit_count in names.items():
+                own_names[name] = own_names.get(name, 0) + hit_count
 
 LinesSummary = dict[int, Union[int, GroupSummary]]
 
@@ -37,15 +52,29 @@ class FileSummary:
     line_stats: LinesSummary = field(default_factory=dict)
 
     def update_summary(self):
-        self.summary = Summary()
+        hit = total = 0
         for line in self.line_stats.values():
             if isinstance(line, int):
-                self.summary.hit += 1 if line > 0 else 0
-                self.summary.total += 1
+                if line > 0:
+                    hit += 1
+                total += 1
             else:
                 line.update_summary()
-                self.summary.hit += line.summary.hit
-                self.summary.total += line.summary.total
+                hit += line.summary.hit
+                total += line.summary.total
+        self.summary = Summary(hit, total)
+
+    def merge(self, other: 'FileSummary'):
+        # Follows `Report.create_counter`: hits from DA entries are dropped for lines with BRDA entries
+        line_stats = self.line_stats
+        for line_num, stats in other.line_stats.items():
+            own_stats = line_stats.get(line_num)
+            if own_stats is None or (isinstance(own_stats, int) and isinstance(stats, GroupSummary)):
+                line_stats[line_num] = stats
+            elif isinstance(own_stats, int):
+                line_stats[line_num] = own_stats + stats
+            elif isinstance(stats, GroupSummary):
+                own_stats.merge(stats)
 
 @dataclass
 class CoverageTypeSummary:
@@ -63,21 +92,19 @@ class Report:
     report: dict[str, dict[str, CoverageTypeSummary]] = field(default_factory=dict)
 
     def __post_init__(self):
-        # Initialize here, so that those fields are not visible to `asdict`
+        # Initialize here, so that those fields are not dataclass fields
         # (and not serialized with the rest of the report)
         self.current_type: str = UNKNOWN_COVERAGE
         self.current_dataset: str = UNKNOWN_COVERAGE
 
     def file_summary_for(self, path: str) -> FileSummary:
-        if self.current_dataset not in self.report:
-            self.report[self.current_dataset] = {}
-        if self.current_type not in self.report[self.current_dataset]:
-            self.report[self.current_dataset][self.current_type] = CoverageTypeSummary()
-
-        ct = self.report[self.current_dataset][self.current_type]
-        if path not in ct.files:
-            ct.files[path] = FileSummary()
-        return ct.files[path]
+        if (coverage_types := self.report.get(self.current_dataset)) is None:
+            coverage_types = self.report[self.current_dataset] = {}
+        if (ct := coverage_types.get(self.current_type)) is None:
+            ct = coverage_types[self.current_type] = CoverageTypeSummary()
+        if (file := ct.files.get(path)) is None:
+            file = ct.files[path] = FileSummary()
+        return file
 
     def all_coverage_types(self) -> Generator[CoverageTypeSummary, Any, None]:
         for dataset in self.report:
@@ -90,8 +117,16 @@ class Report:
                 yield file
 
     def create_counter(self) -> EntryHandler:
+        # All entries of a record are counted one after another, so only look up its summary once
+        last_record: Optional[Record] = None
+        line_stats: LinesSummary = {}
+
         def counter(prefix: str, params: str, file: Record) -> str:
-            line_stats = self.file_summary_for(file.source_file).line_stats
+            nonlocal last_record, line_stats
+            if file is not last_record:
+                last_record = file
+                line_stats = self.file_summary_for(file.source_file).line_stats
+
             if prefix == 'DA':
                 line_num, hit_count = split_da(params)
                 # Note that it's going to be replaced with GroupSummary if there are BRDAs for the same line
@@ -115,6 +150,20 @@ class Report:
 
         return counter
 
+    def merge(self, other: 'Report'):
+        for dataset, coverage_types in other.report.items():
+            own_coverage_types = self.report.setdefault(dataset, {})
+            for coverage_type, ct in coverage_types.items():
+                if (own_ct := own_coverage_types.get(coverage_type)) is None:
+                    own_coverage_types[coverage_type] = ct
+                    continue
+
+                for path, file in ct.files.items():
+                    if (own_file := own_ct.files.get(path)) is None:
+                        own_ct.files[path] = file
+                    else:
+                        own_file.merge(file)
+
     def update_summary(self):
         for file in self.all_files():
             file.update_summary()
@@ -149,7 +198,7 @@ def collect_streams(inputs: list[str]) -> Generator[tuple[TextIO, str, str], Any
             else:
                 raise ValueError(f"Could not establish dataset and coverage type for input file: {path}")
 
-            yield (open(path, 'rt'), coverage_type, dataset)
+            yield (open(path, 'rt', buffering=READ_BUFFER_SIZE), coverage_type, dataset)
         elif path.endswith('.zip'):
             archive = ZipFile(path, 'r')
             try:
@@ -172,15 +221,11 @@ def collect_streams(inputs: list[str]) -> Generator[tuple[TextIO, str, str], Any
         else:
             raise ValueError(f'Unknown file type for generating report: {path}')
 
-def filter_key(value: Any, to_remove: str):
-    if isinstance(value, dict):
-        return {
-            key: filter_key(val, to_remove)
-            for key, val in value.items()
-            if key != to_remove
-        }
-    else:
-        return value
+def encode_dataclass(value: Any, skipped_fields: tuple[str, ...] = ()) -> dict[str, Any]:
+    # Used as the `default` hook of the JSON encoder, which calls it for each dataclass it encounters
+    if not is_dataclass(value):
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+    return {f.name: getattr(value, f.name) for f in fields(value) if f.name not in skipped_fields}
 
 def prepare_args(parser: argparse.ArgumentParser):
     parser.add_argument('input', type=str, nargs='+', default=[],
@@ -192,25 +237,58 @@ def prepare_args(parser: argparse.ArgumentParser):
     parser.add_argument('--file-summary-only', action='store_true', default=False,
                         help='Generate report containing summaries only for files')
 
-def main(args: argparse.Namespace):
+def load_report(path: str) -> tuple[Report, list[tuple[Optional[str], str]]]:
+    # Worker function, so it has to be defined at the module level to be picklable.
+    # Every input is loaded into a separate stream, so that their test names can be checked in order afterwards.
+    # Messages printed while loading are returned with the test names, to be printed in the input order.
     report = Report()
-    stream = Stream()
-    stream.install_handler(['DA', 'BRDA'], report.create_counter())
-
-    for in_stream, coverage_type, dataset in collect_streams(args.input):
+    loaded_inputs = []
+    for in_stream, coverage_type, dataset in collect_streams([path]):
+        stream = Stream(track_line_info=False)
+        stream.install_handler(['DA', 'BRDA'], report.create_counter())
+        messages = StringIO()
         try:
             report.current_type = coverage_type
             report.current_dataset = dataset
-            stream.load(in_stream)
+            with redirect_stdout(messages):
+                stream.load(in_stream)
         finally:
             in_stream.close()
+        loaded_inputs.append((stream.test_name, messages.getvalue()))
+
+    return report, loaded_inputs
+
+def merge_reports(partial_reports: Iterable[tuple[Report, list[tuple[Optional[str], str]]]]) -> Report:
+    # Partial reports are merged and their messages printed as they arrive, in the input order
+    report = Report()
+    first_test_name = None
+    for partial_report, loaded_inputs in partial_reports:
+        report.merge(partial_report)
+        for test_name, messages in loaded_inputs:
+            if test_name is not None:
+                if first_test_name is None:
+                    first_test_name = test_name
+                elif test_name != first_test_name:
+                    print(f"WARNING: Different TN entry: {test_name}, first TN found was: {first_test_name}")
+            print(messages, end='')
+
+    return report
+
+def main(args: argparse.Namespace):
+    if len(args.input) == 1:
+        # Starting a worker process doesn't pay off for a single input
+        report = merge_reports(map(load_report, args.input))
+    else:
+        # Inputs are parsed in parallel, each one in a separate process
+        with ProcessPoolExecutor() as executor:
+            report = merge_reports(executor.map(load_report, args.input))
 
     report.update_summary()
 
-    json_dict = asdict(report)
-    if args.file_summary_only:
-        json_dict = filter_key(json_dict, "line_stats")
+    default = partial(encode_dataclass, skipped_fields=('line_stats',)) if args.file_summary_only else encode_dataclass
 
     with open(args.output, 'wt') as out:
         indent = 2 if args.pretty_print else None
-        json.dump(json_dict, out, indent=indent)
+        # Encode the whole report at once and write it with a single call, json.dump always uses the
+        # pure Python encoder and issues a write for every encoded chunk
+        out.write(json.dumps(report, indent=indent, default=default))
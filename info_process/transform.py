@@ -2,16 +2,21 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+from functools import lru_cache
 from . import handlers
-from .parser import Stream, Record, EntryHandler, RemoveRecord, CategoryHandler, split_brda, split_da
+from .parser import Stream, Record, EntryHandler, RemoveRecord, CategoryHandler, split_brda, split_da, READ_BUFFER_SIZE
 import re
 
 def two_way_toggle_handler(prefix: str, entries: list[str], file: Record) -> list[str]:
     result: list[str] = []
     for entry in entries:
-        line_number, block, name, hit_count = split_brda(entry)
-        result.append(f'{line_number},{block},{name}_0->1,{hit_count}')
-        result.append(f'{line_number},{block},{name}_1->0,{hit_count}')
+        # Name is the last field before the hit count, so suffixes can be appended
+        # directly to the `line_number,block,name` part without splitting it
+        base, _, hit_count = entry.rpartition(',')
+        if hit_count == '-':
+            hit_count = '0'
+        result.append(f'{base}_0->1,{hit_count}')
+        result.append(f'{base}_1->0,{hit_count}')
     return result
 
 def missing_brda_handler(prefix: str, params: str, file: Record) -> str:
@@ -20,7 +25,13 @@ def missing_brda_handler(prefix: str, params: str, file: Record) -> str:
         file.add('BRDA', f'{line_number},0,toggle,{hit_count}')
     return params
 
+# The same source file can be listed in multiple records, e.g. one for each coverage type
+@lru_cache(maxsize=4096)
 def normalize_path(path):
+    # Most paths have no empty, "." or ".." components, so they are already normalized
+    if '//' not in path and '/.' not in path and not path.startswith('.') and not path.endswith('/'):
+        return path
+
     normalized_components = []
     components = path.split("/")
     for comp in components:
@@ -37,34 +48,51 @@ def normalize_path_handler(prefix: str, path: str, file: Record) -> str:
     normalized_path = normalize_path(path)
     return normalized_path
 
+def is_literal_pattern(pattern: str) -> bool:
+    # Patterns without any special characters can be handled with plain string operations
+    return re.escape(pattern) == pattern
+
 def create_filter_handler(pattern: str, negate: bool = False) -> EntryHandler:
-    regex = re.compile(pattern)
+    # Each kind of pattern gets its own handler, so that paths are checked without an additional Python call
+    if is_literal_pattern(pattern):
+        def handler(prefix: str, path: str, file: Record) -> str:
+            if negate != (pattern in path):
+                return path
+            raise RemoveRecord()
+
+        return handler
+
+    search = re.compile(pattern).search
     def handler(prefix: str, path: str, file: Record) -> str:
-        if negate != (regex.search(path) is not None):
+        if negate != (search(path) is not None):
             return path
         raise RemoveRecord()
 
     return handler
 
 def create_path_strip_handler(pattern: str) -> EntryHandler:
-    regex = re.compile(pattern)
+    if is_literal_pattern(pattern):
+        def handler(prefix: str, path: str, file: Record) -> str:
+            return path.removeprefix(pattern)
+
+        return handler
+
+    match = re.compile(pattern).match
     def handler(prefix: str, path: str, file: Record) -> str:
         # Match the pattern from the start and remove what got matched from the path
-        if (m := regex.match(path)):
+        if (m := match(path)):
             return path[m.end():]
         return path
 
     return handler
 
-def normalize_hit_count_handler(prefix: str, params: str, file: Record) -> str:
-    if prefix == 'DA':
-        line_number, hit_count = split_da(params)
-        return f'{line_number},{hit_count > 0:d}'
-    elif prefix == 'BRDA':
-        line_number, block, name, hit_count = split_brda(params)
-        return f'{line_number},{block},{name},{hit_count > 0:d}'
-    else:
-        raise Exception(f'Unsupported prefix: {prefix}')
+def normalize_da_hit_count_handler(prefix: str, params: str, file: Record) -> str:
+    line_number, hit_count = split_da(params)
+    return f'{line_number},{1 if hit_count > 0 else 0}'
+
+def normalize_brda_hit_count_handler(prefix: str, params: str, file: Record) -> str:
+    line_number, block, name, hit_count = split_brda(params)
+    return f'{line_number},{block},{name},{1 if hit_count > 0 else 0}'
 
 def create_block_ids_handler(increment: int) -> CategoryHandler:
     if increment <= 0:
@@ -75,20 +103,30 @@ def create_block_ids_handler(increment: int) -> CategoryHandler:
         counter = 0
         increment_counter = -1
         current_line = -1
+        # `line_number,block_id,` part shared by consecutive entries, only formatted when it changes
+        line_and_block = ''
         for line in entries:
-            line_number, _, name, hit_count = split_brda(line)
+            # Only the line number is needed to assign block IDs, the rest is copied as-is
+            line_number, _, name_and_hit_count = line.split(',', 2)
+            line_number = int(line_number)
+            if name_and_hit_count[-1:] == '-':
+                name, _, hit_count = name_and_hit_count.rpartition(',')
+                if hit_count == '-':
+                    name_and_hit_count = f'{name},0'
             # group just based on line numbers
             if current_line != line_number:
                 counter = 0
                 increment_counter = -1
                 current_line = line_number
+                line_and_block = f'{line_number},{counter},'
 
             increment_counter += 1
             if increment_counter == increment:
                 increment_counter = 0
                 counter += 1
+                line_and_block = f'{line_number},{counter},'
 
-            result.append(f'{line_number},{counter},{name},{hit_count}')
+            result.append(line_and_block + name_and_hit_count)
         return result
     return handler
 
@@ -146,7 +184,8 @@ def main(args: argparse.Namespace):
         stream.install_handler(['DA'], missing_brda_handler)
 
     if args.normalize_hit_counts:
-        stream.install_handler(['DA', 'BRDA'], normalize_hit_count_handler)
+        stream.install_handler(['DA'], normalize_da_hit_count_handler)
+        stream.install_handler(['BRDA'], normalize_brda_hit_count_handler)
 
     # Always fix counts reported in BRF, BRH, LF and LH
     stream.install_category_handler(['BRF'], handlers.create_count_restore('BRDA'))
@@ -154,7 +193,7 @@ def main(args: argparse.Namespace):
     stream.install_category_handler(['LF'], handlers.create_count_restore('DA'))
     stream.install_category_handler(['LH'], handlers.create_hit_count_restore('DA'))
 
-    with open(args.input, 'rt') as f:
+    with open(args.input, 'rt', buffering=READ_BUFFER_SIZE) as f:
         stream.load(f)
 
     with open(args.output, 'wt') as f:
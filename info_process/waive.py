@@ -1,6 +1,7 @@
 # Copyright (c) Antmicro
 # SPDX-License-Identifier: Apache-2.0
 
+from bisect import bisect_right
 from dataclasses import dataclass
 from pathlib import Path
 import argparse
@@ -23,6 +24,10 @@ class ExplicitWaivers:
 
     def __init__(self, path: Path = None) -> None:
         self.excluded: dict[str, list[ExplicitWaivers.Exclude]] = {}
+        # Indexes built from `excluded` for `is_excluded`, see `_index_exclusions`
+        self.excluded_files: set[str] = set()
+        self.excluded_lines: dict[str, tuple[list[int], list[int]]] = {}
+        self.excluded_groups: dict[str, list[ExplicitWaivers.Exclude]] = {}
 
         if path is None:
             # For such case is_excluded always returns False, so no exclusion at all
@@ -47,45 +52,75 @@ class ExplicitWaivers:
                     group_end=get_or_default(row, 4, 5),
                 ))
 
+        self._index_exclusions()
+
+    def _index_exclusions(self):
+        # Waivers of whole lines are merged into sorted, disjoint line ranges, so that a line can be checked
+        # with a binary search. Files waived as a whole and waivers of group ranges are kept separately.
+        for file, blacklist in self.excluded.items():
+            line_ranges = []
+            for entry in blacklist:
+                if entry.group_start == entry.group_end == self.GROUP_WHOLE_LINE_MARKER:
+                    if entry.line_start == entry.line_end == self.LINE_NUMBER_WHOLE_FILE_MARKER:
+                        self.excluded_files.add(file)
+                    else:
+                        line_ranges.append((entry.line_start, entry.line_end))
+                else:
+                    self.excluded_groups.setdefault(file, []).append(entry)
+
+            starts, ends = [], []
+            for start, end in sorted(line_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            if starts:
+                self.excluded_lines[file] = (starts, ends)
+
     # if group_number < 0, entry is considered excluded without checking if it is in an excluded group range
     # (used for excluding entries that don't have any group information, e.g. `DA` entries)
     # if full_line == True, entry is considered excluded only if there is a waiver excluding the entire line
     # (used for DESC files, where `TEST` should not be removed when only some group ranges are removed
     # to make ensure that test information is not discarded for remaining groups on this line)
     def is_excluded(self, file: str, line_number: int, group_number: int=-1, full_line: bool=False) -> bool:
-        for path, blacklist in self.excluded.items():
-            if not file == path:
-                # Exclusion list doesn't impact the file
-                continue
+        if file in self.excluded_files:
+            return True
 
-            for entry in blacklist:
-                line_excluded = (entry.line_start == entry.line_end == self.LINE_NUMBER_WHOLE_FILE_MARKER) or \
-                    (entry.line_start <= line_number <= entry.line_end)
+        if (line_ranges := self.excluded_lines.get(file)) is not None:
+            starts, ends = line_ranges
+            # The only range which can contain the line is the last one starting at or before it
+            index = bisect_right(starts, line_number) - 1
+            if index >= 0 and line_number <= ends[index]:
+                return True
 
-                if full_line:
-                    group_excluded = (entry.group_start == entry.group_end == self.GROUP_WHOLE_LINE_MARKER)
-                else:
-                    group_excluded = group_number < 0 or (entry.group_start == entry.group_end == self.GROUP_WHOLE_LINE_MARKER) or \
-                        (entry.group_start <= group_number <= entry.group_end)
+        if full_line:
+            # Waivers of group ranges never exclude entire lines
+            return False
 
-                if line_excluded and group_excluded:
-                    # Exclusion entry matched
-                    return True
+        for entry in self.excluded_groups.get(file, ()):
+            line_excluded = (entry.line_start == entry.line_end == self.LINE_NUMBER_WHOLE_FILE_MARKER) or \
+                (entry.line_start <= line_number <= entry.line_end)
+            group_excluded = group_number < 0 or (entry.group_start <= group_number <= entry.group_end)
+
+            if line_excluded and group_excluded:
+                # Exclusion entry matched
+                return True
 
         return False
 
 def create_waivers_handler(waivers: ExplicitWaivers):
     def filter_waivers(prefix: str, data: list[str], file: Record) -> list[str]:
-        passed = []
-        for entry in data:
-            if prefix == 'BRDA':
-                line, group, _, __ = split_brda(entry)
-            elif prefix == 'DA':
-                line, _ = split_da(entry)
-                group = -1
-            if not waivers.is_excluded(file.source_file, line, group):
-                passed.append(entry)
-        return passed
+        source_file = file.source_file
+        if source_file not in waivers.excluded:
+            # Nothing can be excluded from files without waivers
+            return data
+
+        is_excluded = waivers.is_excluded
+        if prefix == 'BRDA':
+            # Only the line number and the group of BRDA entries are checked
+            return [entry for entry in data if not is_excluded(source_file, *split_brda(entry)[:2])]
+        return [entry for entry in data if not is_excluded(source_file, split_da(entry)[0])]
 
     return filter_waivers
 
@@ -114,10 +149,10 @@ def main(args: argparse.Namespace):
     waivers = ExplicitWaivers(Path(args.waivers))
 
     if args.input.endswith('.desc'):
-        stream = Stream(source_file_prefix='SN')
+        stream = Stream(source_file_prefix='SN', track_line_info=False)
         stream.install_handler(['TEST'], create_desc_waivers_handler(waivers))
     else:
-        stream = Stream()
+        stream = Stream(track_line_info=False)
         stream.install_category_handler(['BRDA', 'DA'], create_waivers_handler(waivers))
         stream.install_category_handler(['BRF'], handlers.create_count_restore('BRDA'))
         stream.install_category_handler(['BRH'], handlers.create_hit_count_restore('BRDA'))
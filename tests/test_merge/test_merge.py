@@ -1,9 +1,16 @@
+import argparse
+import io
 import pytest
-from info_process.merge import strip_test_name_simple, strip_test_name_regex
+from info_process.merge import strip_test_name_simple, strip_test_name_regex, expand_brda_name, setup_info_stream
+from info_process.parser import Stream
 
 simple_strip_data = [
     (("./folder/some_file_name.info", ".info,./folder/"), "some_file_name"),
     ((r"/src/folder/nested_folder/.pReFiX\ somefile.suffix", r".pReFiX\ ,.suffix"), "/src/folder/nested_folder/somefile"),
+    # Substrings are removed in the given order, even if they overlap
+    (("coverage-foo-all.info", ".info,coverage-,-all.info"), "foo-all"),
+    (("abc", "bc,ab"), "a"),
+    (("aabb", "ab"), "ab"),
 ]
 
 regex_strip_data = [
@@ -21,6 +28,80 @@ def test_simple_strip(inputs, expected):
     assert result == expected
 
 @pytest.mark.parametrize("inputs,expected", regex_strip_data)
-def test_simple_strip(inputs, expected):
+def test_regex_strip(inputs, expected):
     result = strip_test_name_regex(*inputs)
     assert result == expected
+
+brda_name_expand_data = [
+    ("toggle", "toggle"),
+    ("toggle_10_1", "toggle_" + "10".zfill(20) + "_" + "1".zfill(20)),
+    ("sig[3]", "sig[" + "3".zfill(20) + "]"),
+]
+
+@pytest.mark.parametrize("name,expected", brda_name_expand_data)
+def test_expand_brda_name(name, expected):
+    assert expand_brda_name(name) == expected
+
+summaries_after_entries_info = """TN:
+SF:a.c
+DA:1,1
+DA:2,0
+LF:2
+LH:1
+BRDA:3,0,b,0
+BRDA:3,1,c,1
+BRF:2
+BRH:1
+end_of_record
+"""
+
+summaries_before_entries_info = """TN:
+SF:a.c
+LH:1
+LF:2
+DA:2,3
+DA:1,0
+BRH:1
+BRF:2
+BRDA:3,4,b,2
+BRDA:3,0,c,0
+end_of_record
+"""
+
+# Duplicate entries are merged into one with summed hit counts and the highest block number
+merge_data = [
+    ([summaries_after_entries_info, summaries_before_entries_info], """TN:
+SF:a.c
+DA:1,1
+DA:2,3
+LF:2
+LH:2
+BRDA:3,1,c,1
+BRDA:3,4,b,2
+BRF:2
+BRH:2
+end_of_record
+"""),
+    ([summaries_before_entries_info, summaries_after_entries_info], """TN:
+SF:a.c
+LH:2
+LF:2
+DA:1,1
+DA:2,3
+BRH:2
+BRF:2
+BRDA:3,1,c,1
+BRDA:3,4,b,2
+end_of_record
+"""),
+]
+
+@pytest.mark.parametrize("inputs,expected", merge_data)
+def test_merge_duplicate_entries(inputs, expected):
+    stream = setup_info_stream(Stream(), argparse.Namespace(sort_brda_names=False))
+    for i, info in enumerate(inputs):
+        stream.merge(io.StringIO(info), f"test_{i}")
+
+    output = io.StringIO()
+    stream.save(output)
+    assert output.getvalue() == expected
@@ -0,0 +1,96 @@
+import argparse
+import pytest
+from info_process.parser import Stream
+from info_process.report import Report, collect_streams, load_report, main
+
+first_info = """TN:test
+SF:a.c
+DA:1,1
+DA:2,0
+BRDA:3,0,x,1
+end_of_record
+SF:b.c
+DA:1,0
+end_of_record
+"""
+
+# Line 1 of a.c has only a DA entry in the first input and BRDA entries in the second one,
+# line 3 the other way round
+second_info = """TN:test
+SF:a.c
+DA:1,2
+BRDA:1,0,y,0
+BRDA:1,1,y,3
+DA:2,4
+DA:3,1
+BRDA:3,0,x,0
+end_of_record
+SF:c.c
+DA:5,1
+end_of_record
+"""
+
+def load_single_report(paths: list[str]) -> Report:
+    # All inputs loaded into a single stream, one after another
+    report = Report()
+    stream = Stream(track_line_info=False)
+    stream.install_handler(['DA', 'BRDA'], report.create_counter())
+    for in_stream, coverage_type, dataset in collect_streams(paths):
+        try:
+            report.current_type = coverage_type
+            report.current_dataset = dataset
+            stream.load(in_stream)
+        finally:
+            in_stream.close()
+    return report
+
+@pytest.mark.parametrize("infos", [
+    [first_info, second_info],
+    [second_info, first_info],
+    [first_info, second_info, first_info],
+])
+@pytest.mark.parametrize("names", [
+    ["coverage_line_ds.info"] * 3,
+    ["coverage_line_ds.info", "coverage_branch_ds.info", "coverage_line_other.info"],
+])
+def test_merged_report_matches_single_stream(tmp_path, infos, names):
+    paths = []
+    for i, (info, name) in enumerate(zip(infos, names)):
+        (tmp_path / str(i)).mkdir()
+        path = tmp_path / str(i) / name
+        path.write_text(info)
+        paths.append(str(path))
+
+    expected = load_single_report(paths)
+    expected.update_summary()
+
+    merged = Report()
+    for path in paths:
+        partial_report, loaded_inputs = load_report(path)
+        assert loaded_inputs == [("test", "")]
+        merged.merge(partial_report)
+    merged.update_summary()
+
+    assert merged == expected
+
+@pytest.mark.parametrize("count", [1, 3])
+def test_messages_in_input_order(tmp_path, capsys, count):
+    infos = [
+        "TN:a\nSF:a.c\nDA:1,1\nend_of_record\n",
+        "TN:b\nSF:a.c\ninvalid\nDA:1,1\nend_of_record\n",
+        "SF:a.c\nDA:2,1\nend_of_record\n",
+    ]
+    expected = [
+        "",
+        "WARNING: Different TN entry: b, first TN found was: a\nWarning: Ignoring invalid line 3: invalid\n",
+        "WARNING: Missing TN entry\n",
+    ]
+    paths = []
+    for i, info in enumerate(infos[:count]):
+        (tmp_path / str(i)).mkdir()
+        path = tmp_path / str(i) / "coverage_line_ds.info"
+        path.write_text(info)
+        paths.append(str(path))
+
+    main(argparse.Namespace(input=paths, output=str(tmp_path / "report.json"), pretty_print=False, file_summary_only=False))
+    assert capsys.readouterr().out == "".join(expected[:count])
@@ -0,0 +1,54 @@
+import pytest
+from info_process.waive import ExplicitWaivers
+
+waivers_csv = """a.c,10,20
+a.c,15,30
+a.c,31,35
+a.c,40,40
+a.c,50,60,2,3
+b.c
+"""
+
+is_excluded_data = [
+    # Range boundaries
+    (("a.c", 9), False),
+    (("a.c", 10), True),
+    (("a.c", 20), True),
+    # Overlapping ranges
+    (("a.c", 25), True),
+    (("a.c", 30), True),
+    # Adjacent ranges
+    (("a.c", 31), True),
+    (("a.c", 35), True),
+    (("a.c", 36), False),
+    # Single line ranges
+    (("a.c", 39), False),
+    (("a.c", 40), True),
+    (("a.c", 41), False),
+    # Entries without a group are excluded by waivers of group ranges too
+    (("a.c", 50), True),
+    (("a.c", 55, 1), False),
+    (("a.c", 55, 2), True),
+    (("a.c", 60, 3), True),
+    (("a.c", 61, 2), False),
+    # Waivers of group ranges never exclude entire lines
+    (("a.c", 55, -1, True), False),
+    (("a.c", 40, -1, True), True),
+    # Whole files
+    (("b.c", 1), True),
+    (("b.c", 1, 5, True), True),
+    (("c.c", 10), False),
+]
+
+@pytest.fixture
+def waivers(tmp_path):
+    path = tmp_path / "waivers.csv"
+    path.write_text(waivers_csv)
+    return ExplicitWaivers(path)
+
+@pytest.mark.parametrize("inputs,expected", is_excluded_data)
+def test_is_excluded(waivers, inputs, expected):
+    assert waivers.is_excluded(*inputs) == expected
+
+def test_no_waivers():
+    assert not ExplicitWaivers().is_excluded("a.c", 1)